@@ -2,7 +2,8 @@ import logging
 import json
 from pathlib import Path
 import pika
-from typing import Any, Callable, Dict, Iterator
+import re
+from typing import Any
 
 from aetherscale import config
 from aetherscale import services
@@ -16,33 +17,54 @@ QUEUE_COMMANDS_MAP = {
     COMPETING_QUEUE: ['create-vm'],
 }
 
+# Most responses only consist of a status and a VM ID. They are filled into
+# a pre-encoded template instead of being serialized with json.dumps.
+STATUS_RESPONSE_TEMPLATE = \
+    b'{"execution-info": {"status": "success"}, ' \
+    b'"response": {"status": "%s", "vm-id": "%s"}}'
+_TEMPLATE_SAFE_VALUE_RE = re.compile(r'[a-z0-9-]+\Z')
+
+
+def encode_success_response(response: Any) -> bytes:
+    if isinstance(response, dict) and response.keys() == {'status', 'vm-id'}:
+        status = response['status']
+        vm_id = response['vm-id']
+
+        # only use the template if the values need no escaping
+        if isinstance(status, str) and isinstance(vm_id, str) \
+                and _TEMPLATE_SAFE_VALUE_RE.match(status) \
+                and _TEMPLATE_SAFE_VALUE_RE.match(vm_id):
+            return STATUS_RESPONSE_TEMPLATE % (
+                status.encode('ascii'), vm_id.encode('ascii'))
+
+    resp_message = {
+        'execution-info': {
+            'status': 'success'
+        },
+        'response': response,
+    }
+    return json.dumps(resp_message).encode('utf-8')
+
 
-def noop_responder(_: Dict[str, Any]):
+def noop_responder(_: bytes):
     pass
 
 
 def create_rabbitmq_responder(ch, reply_to: str, correlation_id: str):
-    def rabbitmq_responder(message: Dict[str, Any]):
+    # all responses to a request share the same properties
+    properties = pika.BasicProperties(correlation_id=correlation_id)
+
+    def rabbitmq_responder(message: bytes):
         ch.basic_publish(
             exchange='',
             routing_key=reply_to,
-            properties=pika.BasicProperties(
-                correlation_id=correlation_id
-            ),
-            body=json.dumps(message))
+            properties=properties,
+            body=message)
 
     return rabbitmq_responder
 
 
 def callback(ch, method, properties, body, handler: ComputingHandler):
-    command_fn: Dict[str, Callable[[Dict[str, Any]], Iterator[Any]]] = {
-        'list-vms': handler.list_vms,
-        'create-vm': handler.create_vm,
-        'start-vm': handler.start_vm,
-        'stop-vm': handler.stop_vm,
-        'delete-vm': handler.delete_vm,
-    }
-
     message = body.decode('utf-8')
     logging.debug('Received message: ' + message)
 
@@ -54,9 +76,8 @@ def callback(ch, method, properties, body, handler: ComputingHandler):
         logging.error('No "command" specified in message')
         return
 
-    try:
-        fn = command_fn[command]
-    except KeyError:
+    fn = handler.commands.get(command)
+    if fn is None:
         logging.error(f'Invalid command "{command}" specified')
         return
 
@@ -71,13 +92,7 @@ def callback(ch, method, properties, body, handler: ComputingHandler):
         for response in fn(options):
             # if a function wants to return a response
             # set its execution status to success
-            resp_message = {
-                'execution-info': {
-                    'status': 'success'
-                },
-                'response': response,
-            }
-            responder(resp_message)
+            responder(encode_success_response(response))
     except Exception as e:
         logging.exception('Unhandled exception')
         resp_message = {
@@ -88,7 +103,7 @@ def callback(ch, method, properties, body, handler: ComputingHandler):
                 'reason': str(e),
             }
         }
-        responder(resp_message)
+        responder(json.dumps(resp_message).encode('utf-8'))
 
     ch.basic_ack(delivery_tag=method.delivery_tag)
 
@@ -115,7 +130,7 @@ def run():
                 exchange=EXCHANGE_NAME, queue=queue, routing_key=command)
 
     systemd_path = Path.home() / '.config/systemd/user'
-    service_manager = services.SystemdServiceManager(systemd_path)
+    service_manager = services.create_service_manager(systemd_path)
 
     # TODO: Setup or radvd does not belong here, we will remove it
     # Guest VPNs have to handle IPv6 management on their own
@@ -139,3 +154,5 @@ def run():
         channel.start_consuming()
     except KeyboardInterrupt:
         print('Keyboard interrupt, stopping service')
+    finally:
+        service_manager.close()
@@ -1,3 +1,4 @@
+from functools import lru_cache
 import flask
 from pathlib import Path
 
@@ -8,11 +9,18 @@ from aetherscale import services
 app = flask.Flask(__name__)
 
 
+@lru_cache(maxsize=None)
+def get_service_manager() -> services.ServiceManager:
+    """The service manager is shared by all requests, the D-Bus based one
+    holds a connection to systemd"""
+    systemd_path = Path.home() / '.config/systemd/user'
+    return services.create_service_manager(systemd_path)
+
+
 @app.before_request
 def initialize_handler():
-    systemd_path = Path.home() / '.config/systemd/user'
-    service_manager = services.SystemdServiceManager(systemd_path)
-    handler = ComputingHandler(radvd=None, service_manager=service_manager)
+    handler = ComputingHandler(
+        radvd=None, service_manager=get_service_manager())
     flask.g.handler = handler
 
 
@@ -2,14 +2,19 @@
 
 import argparse
 import json
+import logging
 import pika
 import pika.exceptions
 import sys
+from typing import Optional
+import uuid
 
 from .config import RABBITMQ_HOST
 
 
 EXCHANGE_NAME = 'computing'
+# seconds to wait for responses to a message
+RESPONSE_TIMEOUT = 5
 
 
 class ServerCommunication:
@@ -18,24 +23,44 @@ class ServerCommunication:
             pika.ConnectionParameters(host=RABBITMQ_HOST))
         self.channel = self.connection.channel()
 
-        self.channel.basic_consume(
-            queue='amq.rabbitmq.reply-to',
-            on_message_callback=self.on_response,
-            auto_ack=True)
-
         return self
 
     def on_response(self, ch, method, properties, body):
+        # the consumer is shared by all messages on the connection, a late
+        # reply to a previous message must not be taken for ours
+        if properties.correlation_id != self.correlation_id:
+            logging.debug(
+                f'Dropping response to message {properties.correlation_id}')
+            return
+
         self.responses.append(json.loads(body))
 
+        if self.expected_responses is not None \
+                and len(self.responses) >= self.expected_responses:
+            self.channel.stop_consuming()
+
     def on_timeout(self):
         self.channel.stop_consuming()
 
-    def send_msg(self, data, response_expected=False):
+    def send_msg(
+            self, data, response_expected=False,
+            expected_responses: Optional[int] = None,
+            timeout: float = RESPONSE_TIMEOUT):
+        """Send a message to the computing exchange. With response_expected,
+        responses are collected until the timeout or, if given, until
+        expected_responses have arrived."""
         self.responses = []
+        self.correlation_id = uuid.uuid4().hex
+        self.expected_responses = expected_responses
 
         reply_to = None
         if response_expected:
+            # stop_consuming() in on_timeout cancels all consumers, so the
+            # direct reply-to consumer has to be registered for each message
+            self.channel.basic_consume(
+                queue='amq.rabbitmq.reply-to',
+                on_message_callback=self.on_response,
+                auto_ack=True)
             reply_to = 'amq.rabbitmq.reply-to'
 
         self.channel.basic_publish(
@@ -43,13 +68,19 @@ class ServerCommunication:
             routing_key=data['command'],
             properties=pika.BasicProperties(
                 reply_to=reply_to,
+                correlation_id=self.correlation_id,
                 content_type='application/json',
             ),
             body=json.dumps(data).encode('utf-8'))
 
         if response_expected:
-            self.connection.call_later(5, self.on_timeout)
-            self.channel.start_consuming()
+            timer = self.connection.call_later(timeout, self.on_timeout)
+            try:
+                self.channel.start_consuming()
+            finally:
+                # when all responses arrived early, the timer must not stop
+                # consuming for the next message
+                self.connection.remove_timeout(timer)
 
         return self.responses
 
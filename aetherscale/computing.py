@@ -1,15 +1,20 @@
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from functools import lru_cache
+import json
 import logging
 import os
 from pathlib import Path
-import psutil
-import random
+import platform
 import re
+from secrets import token_hex
 import shlex
 import shutil
-import string
 import subprocess
-import tempfile
-from typing import List, Optional, Dict, Any, Tuple, Iterator
+from typing import List, Optional, Dict, Any, Tuple, Iterable, Iterator, \
+    Callable, TYPE_CHECKING
 
 from aetherscale.paths import \
     user_image_path, qemu_socket_monitor, qemu_socket_guest_agent, \
@@ -22,18 +27,74 @@ from . import services
 from .vpn.tinc import TincVirtualNetwork
 import aetherscale.vpn.radvd
 
+if TYPE_CHECKING:
+    import psutil
+
 
 RADVD_SERVICE_NAME = 'aetherscale-radvd.service'
+# seconds to wait for QEMU to answer on its QMP socket
+QMP_TIMEOUT = 5.0
+
+_VM_UNIT_RE = re.compile(r'aetherscale-vm-([a-z0-9]+)(?:\.service)?\Z')
+_TINC_PORT_RE = re.compile(rb'^Port\s*=\s*(\d+)', re.MULTILINE)
+_QEMU_VERSION_RE = re.compile(r'version (\d+)\.(\d+)')
+
+# QEMU arguments that are the same for all VMs
+_QEMU_STATIC_ARGS = (
+    'qemu-system-x86_64',
+    '-nographic',
+    '-cpu', 'host',
+    '-accel', 'kvm',
+    '-device', 'virtio-serial',
+    '-device', 'virtserialport,chardev=qga0,name=org.qemu.guest_agent.0',
+)
+
+# Usage: tap-setup.sh TAP_DEVICE BRIDGE USER
+# A marker file next to the script records that the device was created here,
+# so that the teardown does not delete a device that existed before.
+TAP_SETUP_SCRIPT = '''#!/usr/bin/env bash
+marker="$(dirname "$0")/created-$1"
+if ! ip link show dev "$1" > /dev/null 2>&1; then
+    sudo ip tuntap add dev "$1" mode tap user "$3"
+    sudo ip link set dev "$1" up
+    touch "$marker"
+fi
+sudo ip link set "$1" master "$2"
+'''
+
+# Usage: tap-teardown.sh TAP_DEVICE
+TAP_TEARDOWN_SCRIPT = '''#!/usr/bin/env bash
+marker="$(dirname "$0")/created-$1"
+sudo ip link set "$1" nomaster
+if [ -e "$marker" ]; then
+    sudo ip link del "$1"
+    rm -f "$marker"
+fi
+'''
 
 logging.basicConfig(level=config.LOG_LEVEL)
 
 
-def create_user_image(vm_id: str, image_name: str) -> Path:
-    base_image = config.BASE_IMAGE_FOLDER / f'{image_name}.qcow2'
+def find_base_image(
+        image_name: str, base_image_folder: Optional[Path] = None) -> Path:
+    if base_image_folder is None:
+        base_image_folder = config.BASE_IMAGE_FOLDER
+
+    base_image = base_image_folder / f'{image_name}.qcow2'
     if not base_image.is_file():
         raise IOError(f'Image "{image_name}" does not exist')
 
-    user_image = user_image_path(vm_id)
+    return base_image
+
+
+def create_user_image(
+        vm_id: str, image_name: str,
+        base_image_folder: Optional[Path] = None,
+        user_image_folder: Optional[Path] = None) -> Path:
+    """Create the image of a VM as overlay of a base image. The folders
+    default to the ones from the configuration."""
+    base_image = find_base_image(image_name, base_image_folder)
+    user_image = user_image_path(vm_id, user_image_folder)
 
     create_img_result = subprocess.run([
         'qemu-img', 'create', '-f', 'qcow2',
@@ -44,68 +105,105 @@ def create_user_image(vm_id: str, image_name: str) -> Path:
     return user_image
 
 
-def setup_script_path(resource_folder: Path, tap_name: str) -> Path:
-    return resource_folder / f'{tap_name}-setup.sh'
+def network_config_folder() -> Path:
+    # resolved on each call so that an overridden config dir is respected
+    return config.AETHERSCALE_CONFIG_DIR / 'networking'
 
 
-def teardown_script_path(resource_folder: Path, tap_name: str) -> Path:
-    return resource_folder / f'{tap_name}-teardown.sh'
+def setup_script_path() -> Path:
+    return network_config_folder() / 'tap-setup.sh'
 
 
-def setup_tap_device(
-        resource_type: ResourceType, resource_name: str,
-        tap_name: str, bridge: str) -> Tuple[Path, Path]:
-    resource_folder = resource_config_path(resource_type, resource_name)
+def teardown_script_path() -> Path:
+    return network_config_folder() / 'tap-teardown.sh'
 
-    iproute = networking.Iproute2Network()
-    iproute.tap_device(tap_name, config.USER, bridge)
 
-    setup_script = setup_script_path(resource_folder, tap_name)
-    teardown_script = teardown_script_path(resource_folder, tap_name)
+def install_tap_scripts():
+    """Write the scripts to create and remove TAP devices for VMs. They are
+    shared by all VMs and receive the device names as arguments."""
+    setup_script = setup_script_path()
+    teardown_script = teardown_script_path()
 
     setup_script.parent.mkdir(parents=True, exist_ok=True)
-    teardown_script.parent.mkdir(parents=True, exist_ok=True)
 
-    with open(setup_script, 'w') as f:
-        f.write(iproute.setup_script())
-    os.chmod(setup_script, 0o755)
+    _write_script(setup_script, TAP_SETUP_SCRIPT)
+    _write_script(teardown_script, TAP_TEARDOWN_SCRIPT)
+
+
+def _write_script(path: Path, content: str):
+    """Write an executable script, setting its mode on creation"""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o755)
+    try:
+        os.write(fd, content.encode('utf-8'))
+        # the mode passed to open is subject to the umask, and does not
+        # apply at all if the file existed before
+        os.fchmod(fd, 0o755)
+    finally:
+        os.close(fd)
+
+
+def setup_tap_device(tap_name: str, bridge: str) -> Tuple[str, str]:
+    """Return the commands that create and remove a TAP device attached to
+    bridge"""
+    networking.Iproute2Network.validate_device_name(tap_name)
+    networking.Iproute2Network.validate_device_name(bridge)
 
-    with open(teardown_script, 'w') as f:
-        f.write(iproute.teardown_script())
-    os.chmod(teardown_script, 0o755)
+    setup_command = shlex.join(
+        [str(setup_script_path()), tap_name, bridge, config.USER])
+    teardown_command = shlex.join([str(teardown_script_path()), tap_name])
 
-    return setup_script, teardown_script
+    return setup_command, teardown_command
 
 
 class ComputingHandler:
     def __init__(
             self, radvd: aetherscale.vpn.radvd.Radvd,
-            service_manager: services.ServiceManager):
+            service_manager: services.ServiceManager,
+            base_image_folder: Optional[Path] = None,
+            user_image_folder: Optional[Path] = None):
 
         self.radvd = radvd
         self.service_manager = service_manager
+        self.base_image_folder = base_image_folder or config.BASE_IMAGE_FOLDER
+        self.user_image_folder = user_image_folder or config.USER_IMAGE_FOLDER
 
         self.established_vpns = self._load_existing_vpns()
         self.available_vpn_ports = config.VPN_PORTS
 
+        # written on the first VM that needs a TAP device, not on every
+        # construction of a handler
+        self._tap_scripts_installed = False
+
+        self.qemu_aio_backend = detect_qemu_aio_backend()
+
+        self.commands: Dict[str, Callable[[Dict[str, Any]], Iterator[Any]]] = {
+            'list-vms': self.list_vms,
+            'create-vm': self.create_vm,
+            'start-vm': self.start_vm,
+            'stop-vm': self.stop_vm,
+            'delete-vm': self.delete_vm,
+        }
+
     def list_vms(self, _: Dict[str, Any]) -> Iterator[List[Dict[str, Any]]]:
-        all_vms = []
+        all_vms = set()
         for service in self.service_manager.list_services():
             try:
-                all_vms.append(vm_id_from_systemd_unit(service))
+                all_vms.add(vm_id_from_systemd_unit(service))
             except ValueError:
                 # Not a VM systemd unit
                 pass
 
-        running_vms = []
-        for proc in psutil.process_iter(['pid', 'name']):
-            if proc.name().startswith('vm-'):
-                vm_id = proc.name()[3:]
-                running_vms.append(vm_id)
+        # keep the output in a stable order
+        all_vms = sorted(all_vms)
 
-        orphaned_vms = set(running_vms).difference(all_vms)
-        for orphaned_vm in orphaned_vms:
-            logging.warning(f'VM "{orphaned_vm} is orphaned')
+        # one status query for all VM units instead of walking all processes
+        unit_names = [systemd_unit_name_for_vm(vm_id) for vm_id in all_vms]
+        unit_status = self.service_manager.bulk_status(unit_names)
+        running_vms = {
+            vm_id for vm_id, unit_name in zip(all_vms, unit_names)
+            if unit_status[unit_name]}
+
+        guest_ips = fetch_all_guest_ip_addresses(running_vms)
 
         vms = []
         for vm_id in all_vms:
@@ -114,16 +212,8 @@ class ComputingHandler:
                     'vm-id': vm_id,
                 })
             else:
-                # Fetch IP info for running VMs
                 # TODO: IP info should be moved to a details request
-                socket_file = qemu_socket_guest_agent(vm_id)
-                hint = None
-                ip_addresses = []
-                try:
-                    fetcher = runtime.GuestAgentIpAddress(socket_file)
-                    ip_addresses = fetcher.fetch_ip_addresses()
-                except QemuException:
-                    hint = 'Could not retrieve IP address for guest'
+                ip_addresses, hint = guest_ips[vm_id]
 
                 msg = {
                     'vm-id': vm_id,
@@ -158,8 +248,7 @@ class ComputingHandler:
         }
 
     def create_vm(self, options: Dict[str, Any]) -> Iterator[Dict[str, str]]:
-        vm_id = ''.join(
-            random.choice(string.ascii_lowercase) for _ in range(8))
+        vm_id = token_hex(4)
         logging.info(f'Starting VM "{vm_id}"')
 
         yield {
@@ -172,29 +261,60 @@ class ComputingHandler:
         except KeyError:
             raise ValueError('Image not specified')
 
-        try:
-            user_image = create_user_image(vm_id, image_name)
-        except (OSError, QemuException):
-            raise
+        qemu_interfaces = []
 
-        if 'init-script' in options:
-            with image.guestmount(user_image) as guest_fs:
-                image.install_startup_script(options['init-script'], guest_fs)
+        network_setup_commands = []
+        network_teardown_commands = []
 
-        qemu_interfaces = []
+        if 'vpn' in options or options.get('public-ip'):
+            self._install_tap_scripts()
+
+        # fail before any network resources are created for the VM
+        find_base_image(image_name, self.base_image_folder)
+
+        # Image creation and VPN setup do not depend on each other and mostly
+        # wait for subprocesses, so run them in parallel
+        vpn_name = options.get('vpn')
+        creates_vpn = vpn_name is not None \
+            and vpn_name not in self.established_vpns
+        vpn_future = None
 
-        network_setup_scripts = []
-        network_teardown_scripts = []
+        try:
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                user_image_future = executor.submit(
+                    create_user_image, vm_id, image_name,
+                    self.base_image_folder, self.user_image_folder)
+
+                if vpn_name is not None:
+                    # TODO: Do we have to assign the VPN mac addr to the
+                    # macvtap?
+                    vpn_future = executor.submit(
+                        self._establish_vpn, vpn_name, vm_id)
 
-        if 'vpn' in options:
-            # TODO: Do we have to assign the VPN mac addr to the macvtap?
-            vpn_tap_device = self._establish_vpn(options['vpn'], vm_id)
+                try:
+                    user_image = user_image_future.result()
+                    self._install_init_script(options, user_image)
+                except BaseException:
+                    # no need to set up a VPN for a VM that cannot start
+                    if vpn_future:
+                        vpn_future.cancel()
+                    raise
+
+                if vpn_future:
+                    vpn_tap_device, setup_command, teardown_command = \
+                        vpn_future.result()
+        except BaseException:
+            # the executor has waited for the VPN setup, undo what succeeded
+            if creates_vpn and vpn_future and not vpn_future.cancelled() \
+                    and vpn_future.exception() is None:
+                self._remove_vpn(self.established_vpns[vpn_name])
+            user_image_path(vm_id, self.user_image_folder).unlink(
+                missing_ok=True)
+            raise
 
-            resource_folder = resource_config_path(ResourceType.VM, vm_id)
-            network_setup_scripts.append(setup_script_path(
-                resource_folder, vpn_tap_device))
-            network_teardown_scripts.append(
-                teardown_script_path(resource_folder, vpn_tap_device))
+        if vpn_future:
+            network_setup_commands.append(setup_command)
+            network_teardown_commands.append(teardown_command)
 
             mac_addr_vpn = networking.create_mac_address()
             logging.debug(
@@ -208,22 +328,23 @@ class ComputingHandler:
             qemu_interfaces.append(privnet)
 
         if 'public-ip' in options and options['public-ip']:
+            # only builds the commands for the unit file, nothing to wait for
+            pub_tap_device = f'pub-{vm_id}'
+            setup_command, teardown_command = setup_tap_device(
+                pub_tap_device, 'br0')
+            network_setup_commands.append(setup_command)
+            network_teardown_commands.append(teardown_command)
+
             mac_addr = networking.create_mac_address()
             logging.debug(
                 f'Assigning MAC address "{mac_addr}" to VM "{vm_id}"')
 
-            pub_tap_device = f'pub-{vm_id}'
             pubnet = runtime.QemuInterfaceConfig(
                 mac_address=mac_addr,
                 type=runtime.QemuInterfaceType.TAP,
                 tap_device=pub_tap_device)
             qemu_interfaces.append(pubnet)
 
-            setup_script, teardown_script = setup_tap_device(
-                ResourceType.VM, vm_id, pub_tap_device, 'br0')
-            network_setup_scripts.append(setup_script)
-            network_teardown_scripts.append(teardown_script)
-
         qemu_config = runtime.QemuStartupConfig(
             vm_id=vm_id,
             hda_image=user_image,
@@ -232,9 +353,8 @@ class ComputingHandler:
         unit_name = systemd_unit_name_for_vm(vm_id)
         self._create_qemu_systemd_unit(
             unit_name, qemu_config,
-            network_setup_scripts, network_teardown_scripts)
-        self.service_manager.start_service(unit_name)
-        self.service_manager.enable_service(unit_name)
+            network_setup_commands, network_teardown_commands)
+        self.service_manager.reload_and_activate(unit_name)
 
         logging.info(f'Started VM "{vm_id}"')
         yield {
@@ -294,10 +414,10 @@ class ComputingHandler:
             if kill_flag:
                 self.service_manager.stop_service(unit_name)
             else:
-                qemu_socket = qemu_socket_monitor(vm_id)
-                qm = runtime.QemuMonitor(
-                    qemu_socket, protocol=runtime.QemuProtocol.QMP)
-                qm.execute('system_powerdown')
+                with closing(self._open_qmp(vm_id)) as qm:
+                    qm.execute('system_powerdown')
+
+            runtime.invalidate_ip_address_cache(qemu_socket_guest_agent(vm_id))
 
             response = {
                 'status': stop_status,
@@ -320,7 +440,7 @@ class ComputingHandler:
         self._exhaust(self.stop_vm(options))
 
         unit_name = systemd_unit_name_for_vm(vm_id)
-        user_image = user_image_path(vm_id)
+        user_image = user_image_path(vm_id, self.user_image_folder)
 
         self.service_manager.uninstall_service(unit_name)
         user_image.unlink()
@@ -357,26 +477,26 @@ class ComputingHandler:
 
     def _create_qemu_systemd_unit(
             self, unit_name: str, qemu_config: runtime.QemuStartupConfig,
-            setup_scripts: List[Path], teardown_scripts: List[Path]):
+            setup_commands: List[str], teardown_commands: List[str]):
         qemu_name = \
             f'qemu-vm-{qemu_config.vm_id},process=vm-{qemu_config.vm_id}'
         qemu_monitor_path = qemu_socket_monitor(qemu_config.vm_id)
         qga_monitor_path = qemu_socket_guest_agent(qemu_config.vm_id)
         qga_chardev = f'socket,path={qga_monitor_path},server,nowait,id=qga0'
 
+        # commas in QEMU option values have to be escaped by doubling them
+        hda_image = str(qemu_config.hda_image.absolute()).replace(',', ',,')
+        qemu_drive = \
+            f'file={hda_image},if=virtio,format=qcow2,' \
+            f'aio={self.qemu_aio_backend},cache=none,discard=unmap'
+
         command = [
-            'qemu-system-x86_64',
-            '-nographic',
-            '-cpu', 'host',
-            '-m', '4096',
-            '-accel', 'kvm',
-            '-hda', str(qemu_config.hda_image.absolute()),
+            *_QEMU_STATIC_ARGS,
+            '-m', str(qemu_config.memory_mb),
+            '-drive', qemu_drive,
             '-name', qemu_name,
             '-qmp', f'unix:{qemu_monitor_path},server,nowait',
             '-chardev', qga_chardev,
-            '-device', 'virtio-serial',
-            '-device',
-            'virtserialport,chardev=qga0,name=org.qemu.guest_agent.0',
         ]
 
         for i, interface in enumerate(qemu_config.interfaces):
@@ -395,61 +515,105 @@ class ComputingHandler:
 
             command += ['-device', device, '-netdev', netdev]
 
-        command = [shlex.quote(arg) for arg in command]
-        command = ' '.join(command)
-
-        with tempfile.NamedTemporaryFile(mode='w+t', delete=False) as f:
-            f.write('[Unit]\n')
-            f.write(f'Description=aetherscale VM {qemu_config.vm_id}\n')
-            f.write('\n')
-            f.write('[Service]\n')
-            for script in setup_scripts:
-                f.write(f'ExecStartPre={script.absolute()}\n')
-            f.write(f'ExecStart={command}\n')
-            for script in teardown_scripts:
-                f.write(f'ExecStopPost={script.absolute()}\n')
-            f.write('\n')
-            f.write('[Install]\n')
-            f.write('WantedBy=default.target\n')
-
-        self.service_manager.install_service(Path(f.name), unit_name)
-        os.remove(f.name)
-
-    def _establish_vpn(self, vpn_name: str, vm_id: str) -> str:
+        command = shlex.join(command)
+
+        unit_parts = [
+            '[Unit]\n',
+            f'Description=aetherscale VM {qemu_config.vm_id}\n',
+            '\n',
+            '[Service]\n',
+        ]
+        unit_parts.extend(
+            f'ExecStartPre={setup_command}\n'
+            for setup_command in setup_commands)
+        unit_parts.append(f'ExecStart={command}\n')
+        unit_parts.extend(
+            f'ExecStopPost={teardown_command}\n'
+            for teardown_command in teardown_commands)
+        unit_parts += [
+            '\n',
+            '[Install]\n',
+            'WantedBy=default.target\n',
+        ]
+
+        import tempfile
+
+        fd, unit_file = tempfile.mkstemp()
+        try:
+            try:
+                os.write(fd, ''.join(unit_parts).encode('utf-8'))
+                # the file might be hard linked as unit, mkstemp creates it
+                # readable for the owner only
+                os.fchmod(fd, 0o644)
+            finally:
+                os.close(fd)
+
+            if not self.service_manager.write_unit_file(
+                    Path(unit_file), unit_name):
+                raise RuntimeError(
+                    f'Could not install unit for VM "{qemu_config.vm_id}"')
+        finally:
+            os.remove(unit_file)
+
+    def _establish_vpn(
+            self, vpn_name: str, vm_id: str) -> Tuple[str, str, str]:
         if self.radvd:
             vpn_network_prefix = self.radvd.generate_prefix()
         else:
             vpn_network_prefix = config.VPN_48_PREFIX + ':0000::/64'
 
+        if vpn_name not in self.established_vpns:
+            # the VPN might have been created by another process, whose ports
+            # are also taken
+            self._refresh_vpns()
+
         if vpn_name in self.established_vpns:
             # TODO: Established VPNs should be restored after daemon re-start
             vpn = self.established_vpns[vpn_name]
         else:
-            logging.info(f'Creating VPN {vpn_name} for VM {vm_id}')
+            vpn = self._create_vpn(vpn_name, vm_id, vpn_network_prefix)
+
+        # Create a new tap device for the VM to use
+        associated_tap_device = 'vpn-' + vm_id
+        setup_command, teardown_command = setup_tap_device(
+            associated_tap_device, vpn.bridge_interface_name)
+
+        logging.debug(
+            f'Created TAP device {associated_tap_device} for VM {vm_id}')
+
+        return associated_tap_device, setup_command, teardown_command
+
+    def _create_vpn(
+            self, vpn_name: str, vm_id: str,
+            vpn_network_prefix: str) -> TincVirtualNetwork:
+        logging.info(f'Creating VPN {vpn_name} for VM {vm_id}')
 
-            vpn_port = self.available_vpn_ports.pop()
-            vpn = TincVirtualNetwork(vpn_name, vpn_port, self.service_manager)
+        vpn_port = self._allocate_vpn_port()
+        vpn = TincVirtualNetwork(vpn_name, vpn_port, self.service_manager)
+
+        try:
             vpn.create_config(config.HOSTNAME)
-            vpn.gen_keypair()
-
-            # Create an uninitialized tap device so that tincd can run
-            # without root permissions
-            # TODO: Assign a more reasonable IP address
-            # TODO: In real environments the host does not have to be exposed,
-            # this is only because I want to proxy IP traffic from the host to
-            # the guest
-            host_vpn_ip = vpn_network_prefix.replace('/64', '1')
-            iproute = networking.Iproute2Network()
-            iproute.tap_device(vpn.interface_name, aetherscale.config.USER)
-            iproute.bridged_network(
-                vpn.bridge_interface_name, vpn.interface_name,
-                ip=host_vpn_ip, flush_ip_device=False)
-            setup_network_script = iproute.setup_script()
-            teardown_network_script = iproute.teardown_script()
+            # the key pair is only needed once tincd starts
+            with vpn.gen_keypair_async():
+                # Create an uninitialized tap device so that tincd can run
+                # without root permissions
+                # TODO: Assign a more reasonable IP address
+                # TODO: In real environments the host does not have to be
+                # exposed, this is only because I want to proxy IP traffic
+                # from the host to the guest
+                host_vpn_ip = vpn_network_prefix.replace('/64', '1')
+                iproute = networking.Iproute2Network()
+                iproute.tap_device(vpn.interface_name, aetherscale.config.USER)
+                iproute.bridged_network(
+                    vpn.bridge_interface_name, vpn.interface_name,
+                    ip=host_vpn_ip, flush_ip_device=False)
+                setup_network_script = iproute.setup_script()
+                teardown_network_script = iproute.teardown_script()
 
             vpn.start_daemon(setup_network_script, teardown_network_script)
 
             self.established_vpns[vpn_name] = vpn
+            self._save_vpn_snapshot()
 
             # Setup radvd for IPv6 auto-configuration
             if self.radvd:
@@ -459,51 +623,293 @@ class ComputingHandler:
                 logging.debug(
                     f'Added device {vpn.bridge_interface_name} to radvd '
                     f'with IPv6 address range {vpn_network_prefix}')
+        except BaseException:
+            # do not leave a half set up VPN behind
+            self._remove_vpn(vpn)
+            raise
 
-        # Create a new tap device for the VM to use
-        associated_tap_device = 'vpn-' + vm_id
-        setup_tap_device(
-            ResourceType.VM, vm_id,
-            associated_tap_device, vpn.bridge_interface_name)
+        return vpn
 
-        logging.debug(
-            f'Created TAP device {associated_tap_device} for VM {vm_id}')
+    def _install_init_script(self, options: Dict[str, Any], user_image: Path):
+        if 'init-script' not in options:
+            return
+
+        if image.guestfs:
+            with image.libguestfs_session(user_image) as g:
+                image.install_startup_script_guestfs(
+                    options['init-script'], g)
+        else:
+            with image.guestmount(user_image) as guest_fs:
+                image.install_startup_script(options['init-script'], guest_fs)
+
+    def _remove_vpn(self, vpn: TincVirtualNetwork):
+        """Remove a VPN that no VM uses, e.g. after a failed VM creation"""
+        logging.info(f'Removing VPN {vpn.netname}')
+
+        # the teardown script of the service removes the network devices
+        self.service_manager.stop_service(vpn.service_name)
+        if vpn.network_exists():
+            vpn.teardown_tinc_config()
+        shutil.rmtree(vpn.net_config_folder.parent, ignore_errors=True)
+
+        if self.radvd and vpn.bridge_interface_name in self.radvd.interfaces:
+            self.radvd.remove_interface(vpn.bridge_interface_name)
+            self.service_manager.restart_service(RADVD_SERVICE_NAME)
 
-        return associated_tap_device
+        if self.established_vpns.pop(vpn.netname, None) is not None:
+            self._save_vpn_snapshot()
+        self.available_vpn_ports.add(vpn.port)
+
+    def _install_tap_scripts(self):
+        if not self._tap_scripts_installed:
+            install_tap_scripts()
+            self._tap_scripts_installed = True
+
+    def _open_qmp(self, vm_id: str) -> runtime.QemuMonitor:
+        """Open a QMP connection to the VM. QEMU serves only one QMP client
+        at a time, so callers have to close it at the end of the request."""
+        return runtime.QemuMonitor(
+            qemu_socket_monitor(vm_id), protocol=runtime.QemuProtocol.QMP,
+            timeout=QMP_TIMEOUT)
 
     def _exhaust(self, generator):
-        all(generator)
+        deque(generator, maxlen=0)
 
     def _load_existing_vpns(self) -> Dict[str, TincVirtualNetwork]:
-        vpns = {}
+        vpn_folder = vpn_config_folder()
+
+        # the snapshot is only written when a VPN is established, loading
+        # never writes to the config dir
+        ports = self._load_vpn_snapshot(vpn_folder)
+        if ports is None:
+            ports = self._scan_vpn_ports(vpn_folder)
+
+        return {
+            netname: TincVirtualNetwork(netname, port, self.service_manager)
+            for netname, port in ports.items()
+        }
+
+    def _refresh_vpns(self):
+        """Add VPNs that other processes, e.g. the REST API next to the
+        broker, have created since this handler was started"""
+        for netname, port in self._scan_vpn_ports(vpn_config_folder()).items():
+            if netname not in self.established_vpns:
+                self.established_vpns[netname] = TincVirtualNetwork(
+                    netname, port, self.service_manager)
 
-        for folder in (config.AETHERSCALE_CONFIG_DIR / 'vpn').iterdir():
-            logging.debug(f'Loading existing VPN "{folder.name}"')
+    def _allocate_vpn_port(self) -> int:
+        used_ports = {vpn.port for vpn in self.established_vpns.values()}
+        free_ports = self.available_vpn_ports - used_ports
+        if not free_ports:
+            raise RuntimeError('No free VPN port left')
 
-            netname = folder.name
+        port = free_ports.pop()
+        self.available_vpn_ports.discard(port)
+        return port
 
-            port = 0
-            vpn_folder = config.AETHERSCALE_CONFIG_DIR / 'vpn' / netname
-            tinc_conf = vpn_folder / 'tinc/tinc.conf'
-            with open(tinc_conf) as f:
-                for line in f:
-                    m = re.match(r'Port\s*=\s*(\d+)', line)
-                    if m:
-                        port = int(m.group(1))
+    def _scan_vpn_ports(self, vpn_folder: Path) -> Dict[str, int]:
+        ports = {}
+
+        try:
+            entries = list(os.scandir(vpn_folder))
+        except FileNotFoundError:
+            # no VPN has been created yet
+            return ports
+
+        for entry in entries:
+            if not entry.is_dir():
+                continue
+
+            netname = entry.name
+            logging.debug(f'Loading existing VPN "{netname}"')
+
+            tinc_conf = Path(entry.path) / 'tinc/tinc.conf'
+            try:
+                m = _TINC_PORT_RE.search(tinc_conf.read_bytes())
+            except FileNotFoundError:
+                # VPN is being created or removed by another process
+                continue
+            port = int(m.group(1)) if m else 0
 
             if port > 0:
-                vpns[netname] = TincVirtualNetwork(
-                    netname, port, self.service_manager)
+                ports[netname] = port
+
+        return ports
+
+    def _load_vpn_snapshot(
+            self, vpn_folder: Path) -> Optional[Dict[str, int]]:
+        """Load the VPN ports from the snapshot file if it is still up to
+        date, i.e. it is newer than the VPN folder and lists exactly the
+        VPN folders that exist"""
+        snapshot = vpn_snapshot_path()
+
+        try:
+            # equal times are no proof on file systems with coarse timestamps
+            if snapshot.stat().st_mtime <= vpn_folder.stat().st_mtime:
+                return None
+
+            ports = json.loads(snapshot.read_text())
+            if set(ports) != set(os.listdir(vpn_folder)):
+                return None
+
+            return ports
+        except (OSError, ValueError):
+            return None
+
+    def _save_vpn_snapshot(self):
+        # other processes might have created VPNs that this handler does not
+        # know about, they must not drop out of the snapshot
+        ports = self._scan_vpn_ports(vpn_config_folder())
+        ports.update(
+            (netname, vpn.port)
+            for netname, vpn in self.established_vpns.items()
+            if vpn.network_exists())
+
+        snapshot = vpn_snapshot_path()
+        tmp_snapshot = snapshot.with_name(f'{snapshot.name}.{os.getpid()}')
+        tmp_snapshot.write_text(json.dumps(ports))
+        os.replace(tmp_snapshot, snapshot)
+
+
+def iter_process_names() -> Iterator[Tuple[int, str]]:
+    """Iterate over PID and name of all processes on the system. This reads
+    /proc/<pid>/comm directly which is much cheaper than letting psutil
+    parse the full process status for each PID."""
+    for entry in os.scandir('/proc'):
+        pid_str = entry.name
+        if not pid_str.isdigit():
+            continue
+
+        try:
+            with open(f'/proc/{pid_str}/comm') as f:
+                name = f.read().rstrip('\n')
+        except OSError:
+            # process has exited in the meantime
+            continue
+
+        yield int(pid_str), name
+
+
+def vpn_config_folder() -> Path:
+    return config.AETHERSCALE_CONFIG_DIR / 'vpn'
+
+
+def vpn_snapshot_path() -> Path:
+    return config.AETHERSCALE_CONFIG_DIR / 'vpn-state.json'
+
+
+@lru_cache(maxsize=None)
+def detect_qemu_aio_backend() -> str:
+    """Use io_uring for disk I/O of VMs if the kernel supports it (Linux 5.1
+    and newer), it has not been disabled and QEMU is recent enough (5.0 and
+    newer), otherwise use a thread pool. AETHERSCALE_QEMU_AIO overrides the
+    detection, e.g. for QEMU builds without liburing."""
+    if config.QEMU_AIO:
+        return config.QEMU_AIO
+
+    try:
+        major, minor = platform.release().split('.')[:2]
+        io_uring_available = (int(major), int(minor)) >= (5, 1)
+    except ValueError:
+        io_uring_available = False
+
+    try:
+        with open('/proc/sys/kernel/io_uring_disabled') as f:
+            if f.read().strip() != '0':
+                io_uring_available = False
+    except OSError:
+        # the switch only exists since Linux 6.6
+        pass
+
+    if io_uring_available:
+        qemu_version = _qemu_version()
+        io_uring_available = qemu_version is not None \
+            and qemu_version >= (5, 0)
+
+    return 'io_uring' if io_uring_available else 'threads'
+
+
+def _qemu_version() -> Optional[Tuple[int, int]]:
+    try:
+        result = subprocess.run(
+            [_QEMU_STATIC_ARGS[0], '--version'], stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL, text=True)
+    except OSError:
+        return None
+
+    m = _QEMU_VERSION_RE.search(result.stdout)
+    if not m:
+        return None
+
+    return int(m.group(1)), int(m.group(2))
+
+
+async def fetch_guest_ip_addresses(
+        vm_id: str) -> Tuple[List[str], Optional[str]]:
+    """Fetch the IP addresses of a running VM from its guest agent. Returns
+    the addresses and a hint for the user if they could not be fetched."""
+    socket_file = qemu_socket_guest_agent(vm_id)
+
+    try:
+        return await runtime.fetch_ip_addresses_async(socket_file), None
+    except (QemuException, OSError, ValueError):
+        return [], 'Could not retrieve IP address for guest'
+
+
+def fetch_all_guest_ip_addresses(
+        vm_ids: Iterable[str]) -> Dict[str, Tuple[List[str], Optional[str]]]:
+    """Fetch the IP addresses of several VMs. Guest agent queries mostly wait
+    for the guests, so they are run concurrently."""
+    vm_ids = list(vm_ids)
+    if len(vm_ids) == 0:
+        return {}
+
+    async def fetch_all():
+        return await asyncio.gather(
+            *(fetch_guest_ip_addresses(vm_id) for vm_id in vm_ids))
+
+    return dict(zip(vm_ids, asyncio.run(fetch_all())))
+
+
+def get_process_for_vm(vm_id: str) -> Optional['psutil.Process']:
+    # psutil loads a C extension, only pay for it when it is actually needed
+    import psutil
+
+    pid = _systemd_main_pid(systemd_unit_name_for_vm(vm_id))
+
+    if pid is None:
+        # QEMU names its process after the VM, see _create_qemu_systemd_unit
+        process_name = f'vm-{vm_id}'
+        pid = next(
+            (pid for pid, name in iter_process_names()
+             if name == process_name),
+            None)
+
+    if pid is None:
+        return None
+
+    try:
+        return psutil.Process(pid)
+    except psutil.NoSuchProcess:
+        return None
 
-        return vpns
 
+def _systemd_main_pid(unit_name: str) -> Optional[int]:
+    try:
+        result = subprocess.run(
+            ['systemctl', '--user', 'show', '-p', 'MainPID', '--value',
+             unit_name],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    except OSError:
+        return None
 
-def get_process_for_vm(vm_id: str) -> Optional[psutil.Process]:
-    for proc in psutil.process_iter(['name']):
-        if proc.name() == vm_id:
-            return proc
+    try:
+        pid = int(result.stdout.strip())
+    except ValueError:
+        return None
 
-    return None
+    # systemd reports 0 for units without a running main process
+    return pid if pid > 0 else None
 
 
 def systemd_unit_name_for_vm(vm_id: str) -> str:
@@ -511,7 +917,7 @@ def systemd_unit_name_for_vm(vm_id: str) -> str:
 
 
 def vm_id_from_systemd_unit(systemd_unit: str) -> str:
-    m = re.match(r'aetherscale-vm-([a-z0-9]+)(?:\.service)?', systemd_unit)
+    m = _VM_UNIT_RE.match(systemd_unit)
     if m:
         return m.group(1)
     else:
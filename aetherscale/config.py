@@ -23,3 +23,9 @@ VPN_48_PREFIX = 'fde7:2361:234a'
 VPN_PORTS = set(range(50000, 51000))
 
 USER = pwd.getpwuid(os.getuid()).pw_name
+
+# socket of aetherscale.privhelper, if unset ip commands are run with sudo
+PRIVHELPER_SOCKET = os.getenv('AETHERSCALE_PRIVHELPER_SOCKET')
+
+# disk I/O backend of QEMU (io_uring, threads or native), detected if unset
+QEMU_AIO = os.getenv('AETHERSCALE_QEMU_AIO')
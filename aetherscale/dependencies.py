@@ -1,5 +1,7 @@
+from functools import lru_cache
+import os
 import shutil
-from typing import List
+from typing import FrozenSet, List, Set
 
 
 BINARY_DEPENDENCIES = {
@@ -19,7 +21,49 @@ BINARY_DEPENDENCIES = {
 
 
 def find_missing_dependencies(dependency_commands: List[str]) -> List[str]:
-    return [cmd for cmd in dependency_commands if not shutil.which(cmd)]
+    found = _find_executables_on_path(
+        {cmd for cmd in dependency_commands if os.sep not in cmd})
+
+    missing = []
+    for cmd in dependency_commands:
+        if os.sep in cmd:
+            # commands with a path are not looked up in PATH
+            if not shutil.which(cmd):
+                missing.append(cmd)
+        elif cmd not in found:
+            missing.append(cmd)
+
+    return missing
+
+
+def _find_executables_on_path(names: Set[str]) -> Set[str]:
+    """Find which of the given executables exist in PATH with one directory
+    scan per PATH entry instead of one lookup per executable and entry"""
+    return set(_scan_path(
+        frozenset(names), os.environ.get('PATH', os.defpath)))
+
+
+@lru_cache(maxsize=256)
+def _scan_path(names: FrozenSet[str], path: str) -> FrozenSet[str]:
+    # PATH is part of the cache key, so a modified PATH is scanned again
+    found: Set[str] = set()
+
+    for directory in path.split(os.pathsep):
+        if found == names:
+            break
+
+        try:
+            with os.scandir(directory or os.curdir) as it:
+                for entry in it:
+                    if entry.name in names and entry.name not in found \
+                            and entry.is_file() \
+                            and os.access(entry.path, os.X_OK):
+                        found.add(entry.name)
+        except OSError:
+            # PATH may contain directories that do not exist
+            continue
+
+    return frozenset(found)
 
 
 def build_dependency_help_text(missing_dependencies: List[str]) -> str:
@@ -1,12 +1,27 @@
+import itertools
 import logging
+import re
 import subprocess
-from typing import List, Iterator
+from typing import List, Iterator, Optional, Tuple
 
 
-def run_command_chain(commands: Iterator[List[str]]) -> bool:
+# ip -batch splits lines at whitespace, cuts them at a # and joins a line
+# ending in a backslash with the next one, so arguments with these characters
+# or control characters could drop arguments or smuggle in a new command
+_UNSAFE_BATCH_ARG = re.compile(r'[\s\x00-\x1f\x7f#\\]')
+# quotes at the start of an argument are interpreted by ip's line parser
+_BATCH_QUOTES = ('"', "'")
+
+
+def run_command_chain(
+        commands: Iterator[List[str]], quiet: bool = False) -> bool:
+    """Run commands one after another until one of them fails. With quiet,
+    the output of the commands is discarded."""
+    output = subprocess.DEVNULL if quiet else None
+
     for command in commands:
         logging.debug(f'Running command: {" ".join(command)}')
-        result = subprocess.run(command)
+        result = subprocess.run(command, stdout=output, stderr=output)
 
         if result.returncode != 0:
             return False
@@ -14,3 +29,61 @@ def run_command_chain(commands: Iterator[List[str]]) -> bool:
     return True
 
 
+def run_ip_batch(commands: Iterator[List[str]], force: bool = False) -> bool:
+    """Run a chain of commands like run_command_chain, but pass consecutive
+    iproute2 commands to a single ip process in batch mode. With force,
+    execution continues after failed commands, e.g. for best-effort
+    cleanups."""
+    all_succeeded = True
+
+    for prefix, group in itertools.groupby(commands, key=_ip_command_prefix):
+        group = list(group)
+
+        if prefix is None:
+            success = run_command_chain(group)
+        elif not all(is_batch_safe(command) for command in group):
+            # run each argv on its own instead of joining it into a batch
+            success = run_command_chain(group)
+        else:
+            success = _run_ip_batch_process(prefix, group, force)
+
+        if not success:
+            if not force:
+                return False
+            all_succeeded = False
+
+    return all_succeeded
+
+
+def is_batch_safe(command: List[str]) -> bool:
+    """Check whether a command can be joined into a line of ip -batch
+    without changing its arguments"""
+    return all(
+        isinstance(arg, str) and arg and not arg.startswith(_BATCH_QUOTES)
+        and not _UNSAFE_BATCH_ARG.search(arg)
+        for arg in command)
+
+
+def _ip_command_prefix(command: List[str]) -> Optional[Tuple[str, ...]]:
+    """Return the arguments up to and including the ip binary or None if the
+    command is no iproute2 command"""
+    if command[:1] == ['ip']:
+        return ('ip',)
+    elif command[:2] == ['sudo', 'ip']:
+        return ('sudo', 'ip')
+    else:
+        return None
+
+
+def _run_ip_batch_process(
+        prefix: Tuple[str, ...], commands: List[List[str]],
+        force: bool = False) -> bool:
+    batch = ''.join(
+        ' '.join(command[len(prefix):]) + '\n' for command in commands)
+    logging.debug(f'Running batch with {" ".join(prefix)}:\n{batch}')
+
+    # without -force ip stops at the first failing line of the batch
+    force_args = ['-force'] if force else []
+    result = subprocess.run(
+        [*prefix, *force_args, '-batch', '-'], input=batch, text=True)
+    return result.returncode == 0
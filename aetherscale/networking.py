@@ -1,22 +1,34 @@
 import logging
-import random
+import os
+from pathlib import Path
 import re
 import shlex
+import socket
 import subprocess
-from typing import Optional
+import time
+from typing import Dict, Optional
 
-from aetherscale import execution
+from aetherscale import config, execution, privhelper
+
+
+# Linux limits interface names to 15 characters (IFNAMSIZ - 1)
+_DEVICE_NAME_RE = re.compile(r'[a-z0-9-]{1,15}\Z')
+# address family -> longest valid prefix length
+_MAX_PREFIX_LENGTHS = {socket.AF_INET: 32, socket.AF_INET6: 128}
+
+# seconds for which a found network device is assumed to still exist
+DEVICE_EXISTENCE_TTL = 2.0
+# device name -> time at which the device was last seen; only positive results
+# are cached so that newly created devices are detected immediately
+_device_existence_cache: Dict[str, float] = {}
 
 
 def create_mac_address() -> str:
+    mac = bytearray(os.urandom(6))
     # Set second least significant bit of leftmost pair to 1 (local)
     # Set least significant bit of leftmost pair to 0 (unicast)
-    mac_bits = (random.getrandbits(48) | 0x020000000000) & 0xfeffffffffff
-    mac_str = '{:012x}'.format(mac_bits)
-    return ':'.join([
-        mac_str[:2], mac_str[2:4], mac_str[4:6],
-        mac_str[6:8], mac_str[8:10], mac_str[10:],
-    ])
+    mac[0] = (mac[0] | 0x02) & 0xfe
+    return mac.hex(':')
 
 
 class NetworkingException(Exception):
@@ -28,6 +40,11 @@ class Iproute2Network:
         self.creation_commands = []
         self.deletion_commands = []
 
+        if config.PRIVHELPER_SOCKET:
+            self._priv = privhelper.get_client(Path(config.PRIVHELPER_SOCKET))
+        else:
+            self._priv = None
+
     def bridged_network(
             self, bridge_device: str, phys_device: str,
             ip: Optional[str] = None, gateway: Optional[str] = None,
@@ -79,7 +96,10 @@ class Iproute2Network:
         if bridge_device:
             Iproute2Network.validate_device_name(bridge_device)
 
-        if Iproute2Network.check_device_existence(tap_device_name):
+        # TAP devices are removed by tincd and the VM teardown scripts outside
+        # of this process, so a cached lookup could be stale
+        if Iproute2Network.check_device_existence(
+                tap_device_name, cache=False):
             logging.debug(
                 f'Device {tap_device_name} already exists, will not re-create')
         else:
@@ -108,10 +128,25 @@ class Iproute2Network:
         return Iproute2Network._to_script(reversed(self.deletion_commands))
 
     def setup(self):
-        return execution.run_command_chain(self.creation_commands)
+        if self._priv:
+            return self._priv.run_chain(self.creation_commands)
+
+        return execution.run_ip_batch(self.creation_commands)
 
     def teardown(self):
-        return execution.run_command_chain(reversed(self.deletion_commands))
+        # remove as much as possible, even if some devices are already gone
+        if self._priv:
+            success = self._priv.run_chain(
+                list(reversed(self.deletion_commands)), force=True)
+        else:
+            success = execution.run_ip_batch(
+                reversed(self.deletion_commands), force=True)
+
+        for command in self.deletion_commands:
+            if command[-3:-1] == ['link', 'del']:
+                _invalidate_device(command[-1])
+
+        return success
 
     @staticmethod
     def _to_script(commands):
@@ -139,9 +174,16 @@ class Iproute2Network:
                 ['sudo', 'ip', 'link', 'del', bridge_device])
 
     @staticmethod
-    def check_device_existence(device: str) -> bool:
+    def check_device_existence(device: str, cache: bool = True) -> bool:
+        """Check whether a network device exists. With cache, a device that
+        was seen recently is assumed to still exist."""
         Iproute2Network.validate_device_name(device)
 
+        last_seen = _device_existence_cache.get(device) if cache else None
+        if last_seen is not None \
+                and time.monotonic() - last_seen < DEVICE_EXISTENCE_TTL:
+            return True
+
         # if ip link show dev [devicename] does not find [devicename], it will
         # write a message to stderr, but none to stdout
         result = subprocess.run(
@@ -149,22 +191,39 @@ class Iproute2Network:
             stderr=subprocess.DEVNULL)
 
         if result.stdout:
+            if cache:
+                _device_existence_cache[device] = time.monotonic()
             return True
         else:
+            _invalidate_device(device)
             return False
 
     @staticmethod
     def validate_device_name(name: str):
-        if len(name) == 0:
-            raise NetworkingException('Zero-length device name not allowed')
-        elif len(name) > 15:
-            raise NetworkingException('Device name must be max. 15 characters')
-        elif not re.match('^[a-z0-9-]+$', name):
+        if not _DEVICE_NAME_RE.match(name):
             raise NetworkingException(
-                f'Invalid name for network device provided ("{name}")')
+                f'Invalid name for network device provided ("{name}"), '
+                'must be 1 to 15 characters of a-z, 0-9 and -')
 
     @staticmethod
     def validate_ip_address(ip_addr: str):
-        if not re.match(r'^[0-9.:a-f]+(/\d+)?$', ip_addr):
-            raise NetworkingException(
-                f'Invalid IP address provided ({ip_addr})')
+        """Validate an IPv4 or IPv6 address with an optional prefix length"""
+        address, slash, prefix_length = ip_addr.partition('/')
+
+        for family, max_prefix_length in _MAX_PREFIX_LENGTHS.items():
+            try:
+                socket.inet_pton(family, address)
+            except OSError:
+                continue
+
+            if not slash:
+                return
+            elif prefix_length.isdigit() and prefix_length.isascii() \
+                    and int(prefix_length) <= max_prefix_length:
+                return
+
+        raise NetworkingException(f'Invalid IP address provided ({ip_addr})')
+
+
+def _invalidate_device(device: str):
+    _device_existence_cache.pop(device, None)
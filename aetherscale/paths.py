@@ -1,5 +1,6 @@
 import enum
 from pathlib import Path
+from typing import Optional
 
 from aetherscale import config
 
@@ -9,8 +10,18 @@ class ResourceType(enum.Enum):
     VPN = enum.auto()
 
 
-def user_image_path(vm_id: str) -> Path:
-    return config.USER_IMAGE_FOLDER / f'{vm_id}.qcow2'
+_RESOURCE_FOLDERS = {
+    ResourceType.VM: 'vm',
+    ResourceType.VPN: 'vpn',
+}
+
+
+def user_image_path(
+        vm_id: str, user_image_folder: Optional[Path] = None) -> Path:
+    if user_image_folder is None:
+        user_image_folder = config.USER_IMAGE_FOLDER
+
+    return user_image_folder / f'{vm_id}.qcow2'
 
 
 def qemu_socket_monitor(vm_id: str) -> Path:
@@ -23,11 +34,10 @@ def qemu_socket_guest_agent(vm_id: str) -> Path:
 
 def resource_config_path(
         resource_type: ResourceType, resource_name: str) -> Path:
-    if resource_type == ResourceType.VM:
-        resource_folder = 'vm'
-    elif resource_type == ResourceType.VPN:
-        resource_folder = 'vpn'
-    else:
+    try:
+        resource_folder = _RESOURCE_FOLDERS[resource_type]
+    except KeyError:
         raise ValueError(f'Unknown resource type {resource_type}')
 
-    return config.AETHERSCALE_CONFIG_DIR / resource_folder / resource_name
+    return config.AETHERSCALE_CONFIG_DIR.joinpath(
+        resource_folder, resource_name)
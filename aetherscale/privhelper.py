@@ -0,0 +1,192 @@
+"""Privileged helper that runs iproute2 commands on behalf of aetherscale.
+
+Running every ip command through sudo costs a sudo startup (PAM, policy
+evaluation) per call. Instead, the helper can be started once as root:
+
+    sudo python -m aetherscale.privhelper /run/aetherscale/priv.sock
+
+and aetherscale will send its ip commands to the socket given in
+AETHERSCALE_PRIVHELPER_SOCKET. Only a small set of ip commands is accepted.
+"""
+import argparse
+from functools import lru_cache
+import json
+import logging
+import os
+from pathlib import Path
+import socket
+import socketserver
+import struct
+import threading
+from typing import Any, List, Optional
+
+from aetherscale import execution
+
+
+# ip objects aetherscale needs, anything else (e.g. netns exec) is refused
+ALLOWED_IP_OBJECTS = {'link', 'addr', 'route', 'tuntap'}
+
+_LENGTH_PREFIX = struct.Struct('!I')
+
+
+class PrivHelperException(Exception):
+    pass
+
+
+def validate_command(command: List[str]):
+    if not isinstance(command, list) or len(command) < 2 \
+            or command[0] != 'ip' or command[1] not in ALLOWED_IP_OBJECTS:
+        raise PrivHelperException(f'Command not allowed: {command}')
+
+    # commands are joined into an ip batch, an argument with a newline or
+    # space in it could smuggle in another command
+    if not execution.is_batch_safe(command):
+        raise PrivHelperException(f'Invalid arguments in command: {command}')
+
+
+class PrivClient:
+    def __init__(self, socket_file: Path):
+        self.socket_file = socket_file
+        self._sock: Optional[socket.socket] = None
+        self._lock = threading.Lock()
+
+    def run_chain(
+            self, commands: List[List[str]], force: bool = False) -> bool:
+        """Run a chain of sudo ip commands in the helper, same semantics as
+        execution.run_ip_batch"""
+        # the helper already runs as root
+        commands = [
+            command[1:] if command[:1] == ['sudo'] else command
+            for command in commands
+        ]
+
+        request = {'commands': commands, 'force': force}
+
+        with self._lock:
+            was_connected = self._sock is not None
+            try:
+                self._send(request)
+            except OSError:
+                self.close()
+                # a re-used connection might have been closed by a restart
+                # of the helper, a fresh one has no excuse
+                if not was_connected:
+                    raise
+                self._send(request)
+
+            # once sent, the helper might have run the commands already, so
+            # the request must not be repeated if the reply gets lost
+            try:
+                response = recv_message(self._sock)
+            except (OSError, PrivHelperException):
+                self.close()
+                raise
+
+        if 'error' in response:
+            raise PrivHelperException(response['error'])
+
+        return response['success']
+
+    def close(self):
+        if self._sock:
+            self._sock.close()
+            self._sock = None
+
+    def _send(self, message: Any):
+        if self._sock is None:
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._sock.connect(str(self.socket_file))
+
+        send_message(self._sock, message)
+
+
+@lru_cache(maxsize=None)
+def get_client(socket_file: Path) -> PrivClient:
+    """Return a client that is shared by all callers using the same helper"""
+    return PrivClient(socket_file)
+
+
+def send_message(sock: socket.socket, message: Any):
+    data = json.dumps(message).encode('utf-8')
+    sock.sendall(_LENGTH_PREFIX.pack(len(data)) + data)
+
+
+def recv_message(sock: socket.socket) -> Any:
+    length, = _LENGTH_PREFIX.unpack(_recv_exactly(sock, _LENGTH_PREFIX.size))
+    return json.loads(_recv_exactly(sock, length).decode('utf-8'))
+
+
+def _recv_exactly(sock: socket.socket, size: int) -> bytes:
+    data = bytearray()
+
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise PrivHelperException('Connection closed by peer')
+        data += chunk
+
+    return bytes(data)
+
+
+class PrivRequestHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        while True:
+            try:
+                request = recv_message(self.request)
+            except PrivHelperException:
+                # client disconnected
+                return
+
+            send_message(self.request, self._execute(request))
+
+    def _execute(self, request: Any) -> Any:
+        try:
+            commands = request['commands']
+            for command in commands:
+                validate_command(command)
+        except (KeyError, TypeError, PrivHelperException) as e:
+            logging.warning(f'Refusing request: {e}')
+            return {'error': str(e)}
+
+        success = execution.run_ip_batch(
+            commands, force=bool(request.get('force', False)))
+        return {'success': success}
+
+
+class PrivServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def create_server(
+        socket_file: Path, owner_uid: Optional[int] = None) -> PrivServer:
+    try:
+        socket_file.unlink()
+    except FileNotFoundError:
+        pass
+
+    server = PrivServer(str(socket_file), PrivRequestHandler)
+
+    # only the user running aetherscale may send commands
+    os.chmod(socket_file, 0o600)
+    if owner_uid is not None:
+        os.chown(socket_file, owner_uid, -1)
+
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Run iproute2 commands for aetherscale as root')
+    parser.add_argument('socket', type=Path, help='Path of the UNIX socket')
+    args = parser.parse_args()
+
+    # when started via sudo, hand the socket to the invoking user
+    sudo_uid = os.getenv('SUDO_UID')
+    owner_uid = int(sudo_uid) if sudo_uid else None
+
+    with create_server(args.socket, owner_uid) as server:
+        server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
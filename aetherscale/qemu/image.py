@@ -1,18 +1,27 @@
 from contextlib import contextmanager
+import io
 import logging
 import os
 from pathlib import Path
-import shutil
 import subprocess
 import tempfile
-from typing import TextIO, Iterator
+import time
+from typing import TextIO, Iterator, List
 
 from aetherscale.execution import run_command_chain
 from aetherscale.qemu.exceptions import QemuException
-import aetherscale.timing
+
+try:
+    import guestfs
+except ImportError:
+    # The libguestfs Python bindings are optional, without them we use the
+    # guestmount binary
+    guestfs = None
 
 
 STARTUP_FILENAME = 'aetherscale-init'
+# seconds to wait between checks whether guestunmount released the image
+WRITE_LOCK_RETRY_DELAYS = (0.05, 0.1, 0.2, 0.4, 0.8, 1.6)
 
 
 @contextmanager
@@ -34,39 +43,113 @@ def guestmount(image_path: Path) -> Iterator[Path]:
         os.rmdir(mount_dir)
 
         # It seems image is not released immediately after guestunmount returns
-        # thus we have to wait until write-lock is released, but at most k
-        # seconds
-        with aetherscale.timing.timeout(seconds=5):
-            logging.debug(f'Waiting for write lock to get released')
-
-            access_ok = False
-            while not access_ok:
-                # qemu-img info fails if write lock cannot be retrieved
-                result = subprocess.run(['qemu-img', 'info', str(image_path)])
-                access_ok = result.returncode == 0
+        # thus we have to wait until write-lock is released, but at most
+        # about three seconds
+        logging.debug('Waiting for write lock to get released')
+        for delay in WRITE_LOCK_RETRY_DELAYS:
+            time.sleep(delay)
+
+            # qemu-img info fails if write lock cannot be retrieved
+            result = subprocess.run(
+                ['qemu-img', 'info', str(image_path)],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            if result.returncode == 0:
+                break
+        else:
+            raise TimeoutError(
+                f'Write lock on {image_path} was not released after unmount')
 
 
 def install_startup_script(script_source: str, mount_dir: Path):
+    startup_unit = io.StringIO()
+    create_systemd_startup_unit(
+        startup_unit, Path(f'/root/{STARTUP_FILENAME}.sh'))
+
     startup_service_path = \
         mount_dir / f'etc/systemd/system/{STARTUP_FILENAME}.service'
-    with open(startup_service_path, 'wt') as f:
-        create_systemd_startup_unit(f, Path(f'/root/{STARTUP_FILENAME}.sh'))
+    _write_file(
+        startup_service_path, [startup_unit.getvalue().encode('utf-8')],
+        0o644)
 
     multi_user_target_path = \
         mount_dir / f'etc/systemd/system/multi-user.target.wants'
     multi_user_target_path.mkdir(parents=True, exist_ok=True)
 
-    with tempfile.NamedTemporaryFile('wt') as startup_script:
-        startup_script.write(script_source)
-        startup_script.flush()
+    executable_target = mount_dir / f'root/{STARTUP_FILENAME}.sh'
+    _write_file(executable_target, [script_source.encode('utf-8')], 0o755)
+
+    os.symlink(
+        f'/etc/systemd/system/{STARTUP_FILENAME}.service',
+        multi_user_target_path / f'{STARTUP_FILENAME}.service')
+
+
+def _write_file(path: Path, chunks: List[bytes], mode: int):
+    """Write all chunks with a single writev call. Each write goes through
+    FUSE when the image is mounted with guestmount, so syscalls are
+    expensive."""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    try:
+        written = os.writev(fd, chunks)
+        if written != sum(len(chunk) for chunk in chunks):
+            raise OSError(f'Could not write all data to {path}')
+
+        # the mode of os.open is subject to the umask
+        os.fchmod(fd, mode)
+    finally:
+        os.close(fd)
+
+
+@contextmanager
+def libguestfs_session(image_path: Path) -> Iterator['guestfs.GuestFS']:
+    """Open an image with the libguestfs Python bindings and mount the
+    filesystems of its OS like guestmount -i does. Unlike guestmount this
+    works in-process without FUSE and without waiting for a write lock."""
+    if guestfs is None:
+        raise QemuException('libguestfs Python bindings are not installed')
+
+    g = guestfs.GuestFS(python_return_dict=True)
+    try:
+        g.add_drive_opts(
+            str(image_path.absolute()), format='qcow2', readonly=False)
+        g.launch()
+
+        roots = g.inspect_os()
+        if len(roots) == 0:
+            raise QemuException(f'Could not find an OS in image {image_path}')
 
-        executable_target = mount_dir / f'root/{STARTUP_FILENAME}.sh'
-        shutil.copyfile(startup_script.name, executable_target)
-        os.symlink(
-            f'/etc/systemd/system/{STARTUP_FILENAME}.service',
-            multi_user_target_path / f'{STARTUP_FILENAME}.service')
+        # mount parents before their children
+        mountpoints = g.inspect_get_mountpoints(roots[0])
+        for mountpoint in sorted(mountpoints, key=len):
+            g.mount(mountpoints[mountpoint], mountpoint)
 
-        os.chmod(executable_target, 0o755)
+        yield g
+
+        g.umount_all()
+        g.shutdown()
+    finally:
+        g.close()
+
+
+def install_startup_script_guestfs(
+        script_source: str, g: 'guestfs.GuestFS'):
+    """Install the startup script into an image opened with
+    libguestfs_session"""
+    startup_unit = io.StringIO()
+    create_systemd_startup_unit(
+        startup_unit, Path(f'/root/{STARTUP_FILENAME}.sh'))
+    g.write(
+        f'/etc/systemd/system/{STARTUP_FILENAME}.service',
+        startup_unit.getvalue())
+
+    g.mkdir_p('/etc/systemd/system/multi-user.target.wants')
+    g.ln_sf(
+        f'/etc/systemd/system/{STARTUP_FILENAME}.service',
+        '/etc/systemd/system/multi-user.target.wants/'
+        f'{STARTUP_FILENAME}.service')
+
+    executable_target = f'/root/{STARTUP_FILENAME}.sh'
+    g.write(executable_target, script_source)
+    g.chmod(0o755, executable_target)
 
 
 def create_systemd_startup_unit(
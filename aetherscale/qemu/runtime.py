@@ -1,3 +1,4 @@
+import asyncio
 from dataclasses import dataclass
 import enum
 import logging
@@ -5,11 +6,18 @@ import json
 from pathlib import Path
 import random
 import socket
-from typing import Any, Dict, Optional, List
+import time
+from typing import Any, Dict, Optional, List, Tuple
 
 from aetherscale.qemu.exceptions import QemuException
 
 
+# seconds for which IP addresses reported by a guest agent are re-used
+IP_ADDRESS_CACHE_TTL = 3.0
+# guest agent socket -> (time of the query, IP addresses)
+_ip_address_cache: Dict[Path, Tuple[float, List[str]]] = {}
+
+
 class QemuInterfaceType(enum.Enum):
     TAP = enum.auto()
     VDE = enum.auto()
@@ -28,6 +36,7 @@ class QemuStartupConfig:
     vm_id: str
     hda_image: Path
     interfaces: List[QemuInterfaceConfig]
+    memory_mb: int = 4096
 
 
 class QemuProtocol(enum.Enum):
@@ -36,15 +45,15 @@ class QemuProtocol(enum.Enum):
 
 
 class QemuMonitor:
-    # TODO: Improve QMP communication, spec is here:
-    # https://github.com/qemu/qemu/blob/master/docs/interop/qmp-spec.txt
+    # QMP spec: https://www.qemu.org/docs/master/interop/qmp-spec.html
     def __init__(
             self, socket_file: Path, protocol: QemuProtocol,
             timeout: Optional[float] = None):
         self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
         self.sock.connect(str(socket_file))
-        self.f = self.sock.makefile('rw')
         self.protocol = protocol
+        # received bytes that do not form a complete line yet
+        self._buffer = bytearray()
 
         if timeout:
             self.sock.settimeout(timeout)
@@ -59,10 +68,20 @@ class QemuMonitor:
         if arguments:
             message['arguments'] = arguments
 
-        json_line = json.dumps(message) + '\r\n'
+        json_line = json.dumps(message).encode('utf-8') + b'\r\n'
         logging.debug(f'Sending message to QEMU: {json_line}')
-        self.sock.sendall(json_line.encode('utf-8'))
-        return json.loads(self.readline())
+        self.sock.sendall(json_line)
+
+        while True:
+            response = json.loads(self.readline())
+
+            # QMP sends asynchronous events on the same channel, they can
+            # pile up on long-lived connections and are not our response
+            if 'event' not in response:
+                return response
+
+    def close(self):
+        self.sock.close()
 
     def _initialize(self):
         if self.protocol == QemuProtocol.QMP:
@@ -74,7 +93,7 @@ class QemuMonitor:
 
     def _initialize_qmp(self):
         # Read the capabilities
-        self.f.readline()
+        self._recv_line()
 
         # Acknowledge the QMP capability negotiation
         self.execute('qmp_capabilities')
@@ -85,30 +104,173 @@ class QemuMonitor:
         self.sock.sendall(prepend_byte)
 
         rand_int = random.randint(100000, 1000000)
-        self.execute('guest-sync', {'id': rand_int})
+        response = self.execute('guest-sync', {'id': rand_int})
 
-        return json.loads(self.readline())
+        # responses to commands of previous connections might still be
+        # queued, everything before our sync response belongs to them
+        while response.get('return') != rand_int:
+            response = json.loads(self.readline())
 
-    def readline(self) -> Any:
+    def readline(self) -> bytes:
         try:
             logging.debug('Waiting for message from QEMU')
-            data = self.f.readline()
+            data = self._recv_line()
             logging.debug(f'Received message from QEMU: {data}')
             return data
         except socket.timeout:
             raise QemuException(
                 'Could not communicate with QEMU, is QMP server or GA running?')
 
+    def _recv_line(self) -> bytes:
+        """Read the next newline-terminated message from the socket"""
+        newline = self._buffer.find(b'\n')
+
+        while newline < 0:
+            chunk = self.sock.recv(4096)
+            if not chunk:
+                # a partial line at the end is no complete message either
+                self._buffer.clear()
+                raise QemuException('connection closed')
+
+            # only search the new data for the line end
+            newline = chunk.find(b'\n')
+            if newline >= 0:
+                newline += len(self._buffer)
+            self._buffer += chunk
+
+        line = bytes(self._buffer[:newline + 1])
+        del self._buffer[:newline + 1]
+        return line
+
+
+class AsyncQemuMonitor:
+    """asyncio variant of QemuMonitor, allows talking to many VMs at the
+    same time without a thread per connection"""
+
+    def __init__(
+            self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+            protocol: QemuProtocol):
+        self.reader = reader
+        self.writer = writer
+        self.protocol = protocol
+
+    @classmethod
+    async def connect(
+            cls, socket_file: Path,
+            protocol: QemuProtocol) -> 'AsyncQemuMonitor':
+        reader, writer = await asyncio.open_unix_connection(str(socket_file))
+        monitor = cls(reader, writer, protocol)
+
+        try:
+            await monitor._initialize()
+        except BaseException:
+            await monitor.close()
+            raise
+
+        return monitor
+
+    async def execute(
+            self, command: str,
+            arguments: Optional[Dict[str, Any]] = None) -> Any:
+        message = {'execute': command}
+        if arguments:
+            message['arguments'] = arguments
+
+        self.writer.write(json.dumps(message).encode('utf-8') + b'\r\n')
+        await self.writer.drain()
+
+        while True:
+            response = json.loads(await self._readline())
+
+            # skip asynchronous QMP events, see QemuMonitor.execute
+            if 'event' not in response:
+                return response
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+
+    async def _initialize(self):
+        if self.protocol == QemuProtocol.QMP:
+            # Read the capabilities
+            await self._readline()
+            await self.execute('qmp_capabilities')
+        elif self.protocol == QemuProtocol.QGA:
+            # make the server flush partial JSON from previous connections
+            self.writer.write(b'\xff')
+
+            sync_id = random.randint(100000, 1000000)
+            response = await self.execute('guest-sync', {'id': sync_id})
+
+            # skip responses queued for previous connections
+            while response.get('return') != sync_id:
+                response = json.loads(await self._readline())
+        else:
+            raise ValueError('Unknown QemuProtocol')
+
+    async def _readline(self) -> bytes:
+        line = await self.reader.readline()
+        # at EOF readline returns an incomplete line without the newline
+        if not line.endswith(b'\n'):
+            raise QemuException('connection closed')
+
+        logging.debug(f'Received message from QEMU: {line}')
+        return line
+
+
+async def fetch_ip_addresses_async(
+        socket_file: Path, timeout: float = 1) -> List[str]:
+    """Fetch the IP addresses of a guest like GuestAgentIpAddress"""
+    ips = _cached_ip_addresses(socket_file)
+    if ips is not None:
+        return ips
+
+    async def fetch():
+        monitor = await AsyncQemuMonitor.connect(
+            socket_file, QemuProtocol.QGA)
+        try:
+            return await monitor.execute('guest-network-get-interfaces')
+        finally:
+            await monitor.close()
+
+    try:
+        response = await asyncio.wait_for(fetch(), timeout)
+    except asyncio.TimeoutError:
+        raise QemuException(
+            'Could not communicate with QEMU, is QMP server or GA running?')
+
+    ips = GuestAgentIpAddress.parse_ips_from_response(response)
+    _cache_ip_addresses(socket_file, ips)
+    return ips
+
 
 class GuestAgentIpAddress:
     def __init__(self, socket_file: Path, timeout: float = 1):
-        self.comm_channel = QemuMonitor(socket_file, QemuProtocol.QGA, timeout)
+        self.socket_file = socket_file
+        self.timeout = timeout
+        self._comm_channel: Optional[QemuMonitor] = None
+
+    @property
+    def comm_channel(self) -> QemuMonitor:
+        # only connect to the guest agent if the cache cannot answer
+        if self._comm_channel is None:
+            self._comm_channel = QemuMonitor(
+                self.socket_file, QemuProtocol.QGA, self.timeout)
+
+        return self._comm_channel
 
     def fetch_ip_addresses(self):
+        ips = _cached_ip_addresses(self.socket_file)
+        if ips is not None:
+            return ips
+
         resp = self.comm_channel.execute('guest-network-get-interfaces')
-        return self._parse_ips_from_response(resp)
+        ips = self.parse_ips_from_response(resp)
+        _cache_ip_addresses(self.socket_file, ips)
+        return ips
 
-    def _parse_ips_from_response(self, response):
+    @staticmethod
+    def parse_ips_from_response(response) -> List[str]:
         ips = []
 
         try:
@@ -119,3 +281,26 @@ class GuestAgentIpAddress:
             return ips
         except KeyError:
             return []
+
+
+def invalidate_ip_address_cache(socket_file: Path):
+    """Forget cached IP addresses of a guest, e.g. when it is stopped"""
+    _ip_address_cache.pop(socket_file, None)
+
+
+def _cached_ip_addresses(socket_file: Path) -> Optional[List[str]]:
+    try:
+        queried_at, ips = _ip_address_cache[socket_file]
+    except KeyError:
+        return None
+
+    if time.monotonic() - queried_at >= IP_ADDRESS_CACHE_TTL:
+        return None
+
+    return ips
+
+
+def _cache_ip_addresses(socket_file: Path, ips: List[str]):
+    # empty results are not cached, the guest might still be booting
+    if ips:
+        _ip_address_cache[socket_file] = (time.monotonic(), ips)
@@ -1,11 +1,26 @@
 from abc import ABC, abstractmethod
+from contextlib import contextmanager
+import errno
+from functools import lru_cache
+import os
 from pathlib import Path
 import shutil
+import string
 import subprocess
-from typing import Optional, List
+import tempfile
+import time
+from typing import Dict, FrozenSet, Iterator, Optional, List, Tuple
 
 from aetherscale.execution import run_command_chain
 
+try:
+    from pystemd.dbusexc import DBusBaseError
+    from pystemd.dbuslib import DBus
+    from pystemd.systemd1 import Manager, Unit
+except ImportError:
+    # pystemd is optional, without it we control systemd with systemctl
+    DBus = None
+
 
 class ServiceManager(ABC):
     @abstractmethod
@@ -20,6 +35,49 @@ class ServiceManager(ABC):
         to make service manager easy to replace, because unlike install_service
         it does not need a service-specific configuration file as input."""
 
+    def install_service_contents(
+            self, contents: str, service_name: str) -> bool:
+        """Installs a service from its configuration given as string"""
+        fd, config_file = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'wt') as f:
+                f.write(contents)
+
+            return self.install_service(Path(config_file), service_name)
+        finally:
+            os.remove(config_file)
+
+    def write_unit_file(self, config_file: Path, service_name: str) -> bool:
+        """Installs a service without making the service manager pick it up
+        yet, reload_and_activate() has to be called afterwards"""
+        return self.install_service(config_file, service_name)
+
+    def reload_and_activate(
+            self, service_name: str,
+            enable: bool = True, start: bool = True) -> bool:
+        """Makes the service manager pick up written unit files and enables
+        and starts the given service"""
+        success = True
+
+        if enable:
+            success = self.enable_service(service_name) and success
+        if start:
+            success = self.start_service(service_name) and success
+
+        return success
+
+    def install_simple_services(
+            self, services: List[Tuple[str, str, Optional[str]]]) -> bool:
+        """Installs several simple services at once, takes tuples of
+        command, service name and description"""
+        success = True
+
+        for command, service_name, description in services:
+            success = self.install_simple_service(
+                command, service_name, description) and success
+
+        return success
+
     @abstractmethod
     def uninstall_service(self, service_name: str) -> bool:
         """Removes a service from the system once it's no longer needed"""
@@ -48,6 +106,10 @@ class ServiceManager(ABC):
     def service_is_running(self, service_name: str) -> bool:
         """Check whether a service is currently running"""
 
+    def bulk_status(self, service_names: List[str]) -> Dict[str, bool]:
+        """Check for several services whether they are currently running"""
+        return {name: self.service_is_running(name) for name in service_names}
+
     @abstractmethod
     def service_exists(self, service_name: str) -> bool:
         """Check whether a service is currently installed"""
@@ -56,12 +118,57 @@ class ServiceManager(ABC):
     def list_services(self) -> List[str]:
         """List all available services"""
 
+    def close(self):
+        """Release resources held by the service manager"""
+
+
+def _link_or_copy(source: Path, target: Path):
+    """Hard link source to target, or copy it if a link is not possible,
+    e.g. because both are on different filesystems"""
+    target.unlink(missing_ok=True)
+
+    try:
+        os.link(source, target)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM):
+            raise
+
+        shutil.copyfile(source, target)
+
+
+_SIMPLE_UNIT_TEMPLATE = string.Template(
+    '[Unit]\n'
+    'Description=${description}\n'
+    '\n'
+    '[Service]\n'
+    'ExecStart=${command}\n'
+    '\n'
+    '[Install]\n'
+    'WantedBy=default.target\n'
+)
+
+
+@lru_cache(maxsize=64)
+def _render_simple_unit(command: str, description: str) -> str:
+    return _SIMPLE_UNIT_TEMPLATE.substitute(
+        command=command, description=description)
+
 
 class SystemdServiceManager(ServiceManager):
     def __init__(self, unit_folder: Path):
         self.unit_folder = unit_folder
 
+        self._batch_depth = 0
+        self._reload_pending = False
+
     def install_service(self, config_file: Path, service_name: str) -> bool:
+        if not self.write_unit_file(config_file, service_name):
+            return False
+
+        return self._daemon_reload()
+
+    def install_service_contents(
+            self, contents: str, service_name: str) -> bool:
         if '.' not in service_name:
             raise ValueError('Unit name must contain the suffix, e.g. .service')
 
@@ -69,17 +176,61 @@ class SystemdServiceManager(ServiceManager):
         target_unit_path.parent.mkdir(parents=True, exist_ok=True)
 
         try:
-            shutil.copyfile(config_file, target_unit_path)
+            target_unit_path.write_text(contents)
         except OSError:
             return False
 
-        # Reload systemd
-        r = subprocess.run(['systemctl', '--user', 'daemon-reload'])
-        return r.returncode == 0
+        return self._daemon_reload()
+
+    def write_unit_file(self, config_file: Path, service_name: str) -> bool:
+        if '.' not in service_name:
+            raise ValueError('Unit name must contain the suffix, e.g. .service')
+
+        target_unit_path = self._systemd_unit_path(service_name)
+        target_unit_path.parent.mkdir(parents=True, exist_ok=True)
+
+        try:
+            _link_or_copy(config_file, target_unit_path)
+        except OSError:
+            return False
+
+        return True
+
+    def reload_and_activate(
+            self, service_name: str,
+            enable: bool = True, start: bool = True) -> bool:
+        # activation needs the new units, reload right away
+        self._reload_pending = False
+        if not self._reload():
+            return False
+
+        if enable:
+            command = ['systemctl', '--user', 'enable', service_name]
+            if start:
+                command.append('--now')
+        elif start:
+            command = ['systemctl', '--user', 'start', service_name]
+        else:
+            return True
+
+        return run_command_chain([command], quiet=True)
 
     def install_simple_service(
             self, command: str, service_name: str,
             description: Optional[str] = None) -> bool:
+        self._write_simple_unit(command, service_name, description)
+        return self._daemon_reload()
+
+    def install_simple_services(
+            self, services: List[Tuple[str, str, Optional[str]]]) -> bool:
+        for command, service_name, description in services:
+            self._write_simple_unit(command, service_name, description)
+
+        return self._daemon_reload()
+
+    def _write_simple_unit(
+            self, command: str, service_name: str,
+            description: Optional[str] = None):
         if '.' not in service_name:
             raise ValueError('Unit name must contain the suffix, e.g. .service')
 
@@ -89,19 +240,7 @@ class SystemdServiceManager(ServiceManager):
         if not description:
             description = f'aetherscale {service_name}'
 
-        with open(target_unit_path, 'wt') as f:
-            f.write('[Unit]\n')
-            f.write(f'Description={description}\n')
-            f.write('\n')
-            f.write('[Service]\n')
-            f.write(f'ExecStart={command}\n')
-            f.write('\n')
-            f.write('[Install]\n')
-            f.write('WantedBy=default.target\n')
-
-        # Reload systemd
-        r = subprocess.run(['systemctl', '--user', 'daemon-reload'])
-        return r.returncode == 0
+        target_unit_path.write_text(_render_simple_unit(command, description))
 
     def uninstall_service(self, service_name: str) -> bool:
         if '.' not in service_name:
@@ -116,33 +255,52 @@ class SystemdServiceManager(ServiceManager):
     def start_service(self, service_name: str) -> bool:
         return run_command_chain([
             ['systemctl', '--user', 'start', service_name],
-        ])
+        ], quiet=True)
 
     def stop_service(self, service_name: str) -> bool:
         return run_command_chain([
             ['systemctl', '--user', 'stop', service_name],
-        ])
+        ], quiet=True)
 
     def restart_service(self, service_name: str) -> bool:
         return run_command_chain([
             ['systemctl', '--user', 'restart', service_name],
-        ])
+        ], quiet=True)
 
     def enable_service(self, service_name: str) -> bool:
         return run_command_chain([
             ['systemctl', '--user', 'enable', service_name],
-        ])
+        ], quiet=True)
 
     def disable_service(self, service_name: str) -> bool:
         return run_command_chain([
             ['systemctl', '--user', 'disable', service_name],
-        ])
+        ], quiet=True)
 
     def service_is_running(self, service_name: str) -> bool:
-        result = subprocess.run([
-            'systemctl', '--user', 'is-active', '--quiet', service_name])
+        result = subprocess.run(
+            ['systemctl', '--user', 'is-active', '--quiet', service_name],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
         return result.returncode == 0
 
+    def bulk_status(self, service_names: List[str]) -> Dict[str, bool]:
+        if len(service_names) == 0:
+            return {}
+
+        # is-active prints one state per line for all given units
+        result = subprocess.run(
+            ['systemctl', '--user', 'is-active', *service_names],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        states = result.stdout.splitlines()
+
+        if len(states) != len(service_names):
+            return super().bulk_status(service_names)
+
+        return {
+            name: state in ('active', 'reloading')
+            for name, state in zip(service_names, states)
+        }
+
     def service_exists(self, service_name: str) -> bool:
         return self._systemd_unit_path(service_name).is_file()
 
@@ -155,5 +313,172 @@ class SystemdServiceManager(ServiceManager):
 
         return services
 
+    @contextmanager
+    def batch(self) -> Iterator[None]:
+        """Defer daemon reloads of all installs inside the block to a single
+        reload at its end"""
+        self._batch_depth += 1
+        try:
+            yield
+        finally:
+            self._batch_depth -= 1
+            if self._batch_depth == 0:
+                self.flush()
+
+    def flush(self) -> bool:
+        """Run a daemon reload if one was deferred"""
+        if not self._reload_pending:
+            return True
+
+        self._reload_pending = False
+        return self._reload()
+
+    def _daemon_reload(self) -> bool:
+        if self._batch_depth > 0:
+            self._reload_pending = True
+            return True
+
+        return self._reload()
+
+    def _reload(self) -> bool:
+        r = subprocess.run(
+            ['systemctl', '--user', 'daemon-reload'],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return r.returncode == 0
+
     def _systemd_unit_path(self, service_name: str) -> Path:
         return self.unit_folder / service_name
+
+
+# seconds to wait for a start or stop job, systemd's default job timeout
+DBUS_JOB_TIMEOUT = 90.0
+
+_RUNNING_STATES = frozenset({b'active', b'reloading'})
+# like systemctl stop, a unit that failed while stopping is stopped as well
+_STOPPED_STATES = frozenset({b'inactive', b'failed'})
+
+
+class DbusSystemdServiceManager(SystemdServiceManager):
+    """Talks to the systemd user instance over D-Bus instead of starting a
+    systemctl process for every action. Unit files are still managed on
+    disk by SystemdServiceManager."""
+
+    def __init__(self, unit_folder: Path):
+        if DBus is None:
+            raise RuntimeError('pystemd is not installed')
+
+        super().__init__(unit_folder)
+
+        self._bus = DBus(user_mode=True)
+        self._bus.open()
+        self._manager = Manager(bus=self._bus, _autoload=True)
+
+    def start_service(self, service_name: str) -> bool:
+        return self._run_job('StartUnit', service_name, _RUNNING_STATES)
+
+    def stop_service(self, service_name: str) -> bool:
+        return self._run_job('StopUnit', service_name, _STOPPED_STATES)
+
+    def restart_service(self, service_name: str) -> bool:
+        return self._run_job('RestartUnit', service_name, _RUNNING_STATES)
+
+    def enable_service(self, service_name: str) -> bool:
+        # runtime=False, force=True
+        return self._call_manager(
+            'EnableUnitFiles', [service_name.encode()], False, True)
+
+    def disable_service(self, service_name: str) -> bool:
+        # runtime=False
+        return self._call_manager(
+            'DisableUnitFiles', [service_name.encode()], False)
+
+    def service_is_running(self, service_name: str) -> bool:
+        return self._active_state(service_name) in _RUNNING_STATES
+
+    def close(self):
+        self._bus.close()
+
+    def reload_and_activate(
+            self, service_name: str,
+            enable: bool = True, start: bool = True) -> bool:
+        # activation needs the new units, reload right away
+        self._reload_pending = False
+        if not self._reload():
+            return False
+
+        if enable and not self.enable_service(service_name):
+            return False
+        if start and not self.start_service(service_name):
+            return False
+
+        return True
+
+    def bulk_status(self, service_names: List[str]) -> Dict[str, bool]:
+        # property reads are cheap, no need to batch them in a systemctl call
+        return {name: self.service_is_running(name) for name in service_names}
+
+    def _reload(self) -> bool:
+        return self._call_manager('Reload')
+
+    def _run_job(
+            self, method: str, service_name: str,
+            expected_states: FrozenSet[bytes]) -> bool:
+        """Queue a job and wait for it like systemctl does. The D-Bus call
+        returns once the job is queued, its outcome shows in the state the
+        unit ends up in."""
+        try:
+            job = getattr(self._manager.Manager, method)(
+                service_name.encode(), b'replace')
+        except DBusBaseError:
+            return False
+
+        if not self._wait_for_job(job):
+            return False
+
+        return self._active_state(service_name) in expected_states
+
+    def _wait_for_job(self, job: bytes) -> bool:
+        deadline = time.monotonic() + DBUS_JOB_TIMEOUT
+        delay = 0.005
+
+        while True:
+            try:
+                jobs = self._manager.Manager.ListJobs()
+            except DBusBaseError:
+                return False
+
+            # the fifth field is the object path of the job
+            if all(queued[4] != job for queued in jobs):
+                return True
+
+            if time.monotonic() >= deadline:
+                return False
+
+            time.sleep(delay)
+            delay = min(delay * 2, 0.1)
+
+    def _active_state(self, service_name: str) -> Optional[bytes]:
+        try:
+            unit = Unit(service_name.encode(), bus=self._bus, _autoload=True)
+            return unit.Unit.ActiveState
+        except DBusBaseError:
+            return None
+
+    def _call_manager(self, method: str, *args) -> bool:
+        try:
+            getattr(self._manager.Manager, method)(*args)
+            return True
+        except DBusBaseError:
+            return False
+
+
+def create_service_manager(unit_folder: Path) -> ServiceManager:
+    """Create the fastest service manager available on this host"""
+    if DBus is not None:
+        try:
+            return DbusSystemdServiceManager(unit_folder)
+        except DBusBaseError:
+            # no user bus available, e.g. when run without a login session
+            pass
+
+    return SystemdServiceManager(unit_folder)
@@ -1,17 +1,42 @@
 from contextlib import contextmanager
-import signal
+import threading
+import time
+from typing import Optional
+
+
+_local = threading.local()
 
 
 @contextmanager
-def timeout(seconds: int):
-    def raise_exception(signum, frame):
-        raise TimeoutError
+def timeout(seconds: float):
+    """Run a block of code with a specified timeout. The block has to call
+    check_deadline() regularly, which raises a TimeoutError once the time is
+    up. Unlike a SIGALRM based timeout this works in any thread."""
+    previous_deadline = getattr(_local, 'deadline', None)
+    deadline = time.monotonic() + seconds
 
-    """Run a block of code with a specified timeout. If the block is not
-    finished after the defined time, raise an exception."""
+    # nested timeouts must not extend an outer deadline
+    if previous_deadline is not None:
+        deadline = min(deadline, previous_deadline)
+
+    _local.deadline = deadline
     try:
-        signal.signal(signal.SIGALRM, raise_exception)
-        signal.alarm(seconds)
         yield None
     finally:
-        signal.signal(signal.SIGALRM, signal.SIG_IGN)
+        _local.deadline = previous_deadline
+
+
+def remaining_time() -> Optional[float]:
+    """Seconds until the deadline of the current timeout block, None if
+    there is no such block"""
+    deadline = getattr(_local, 'deadline', None)
+    if deadline is None:
+        return None
+
+    return deadline - time.monotonic()
+
+
+def check_deadline():
+    remaining = remaining_time()
+    if remaining is not None and remaining <= 0:
+        raise TimeoutError
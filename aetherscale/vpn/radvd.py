@@ -1,6 +1,8 @@
+from contextlib import contextmanager
 import os
 from pathlib import Path
 import tempfile
+from typing import Dict, Iterator, Optional, TextIO
 
 import aetherscale.config
 
@@ -22,7 +24,11 @@ class RadvdException(Exception):
 
 
 class Radvd:
-    def __init__(self, config_file: Path, prefix: str):
+    def __init__(
+            self, config_file: Path, prefix: str,
+            config_stream: Optional[TextIO] = None):
+        """With config_stream, the configuration is written to the stream
+        instead of config_file, e.g. to keep it in memory"""
         if prefix.count(':') != 2:
             raise RadvdException('Prefix must be a /48 prefix')
 
@@ -32,6 +38,16 @@ class Radvd:
         # This is a poor man's method to check prefix overlap; we only
         # check for duplicate prefixes
         self.assigned_prefixes = set()
+        # interface name -> prefix, to rewrite the config on removals
+        self.interfaces: Dict[str, str] = {}
+
+        self.config_stream = config_stream
+
+        # open config file while inside of bulk_edit()
+        self._bulk_file: Optional[TextIO] = None
+
+        if self.config_stream is not None:
+            return
 
         # Create an empty configuration file
         if self.config_file.is_file():
@@ -44,7 +60,17 @@ class Radvd:
         if len(self.assigned_prefixes) >= 65536:
             raise RadvdException('Max number of available networks reached')
 
-        return self.prefix + ':' + str(len(self.assigned_prefixes)) + '::/64'
+        prefix = self._nth_prefix(len(self.assigned_prefixes))
+        if prefix not in self.assigned_prefixes:
+            return prefix
+
+        # an interface was removed, re-use the first free prefix
+        return next(
+            self._nth_prefix(i) for i in range(65536)
+            if self._nth_prefix(i) not in self.assigned_prefixes)
+
+    def _nth_prefix(self, n: int) -> str:
+        return self.prefix + ':' + str(n) + '::/64'
 
     def add_interface(self, interface_name: str, prefix: str):
         if prefix in self.assigned_prefixes:
@@ -54,17 +80,68 @@ class Radvd:
             .replace('INTERFACE', interface_name) \
             .replace('PREFIX', prefix)
 
+        if self._bulk_file:
+            self._bulk_file.write('\n\n' + config_block)
+            self.assigned_prefixes.add(prefix)
+            self.interfaces[interface_name] = prefix
+            return
+
+        with self.bulk_edit():
+            self.add_interface(interface_name, prefix)
+
+    def remove_interface(self, interface_name: str):
+        """Remove an interface and release its prefix. The configuration is
+        written again from the remaining interfaces."""
+        prefix = self.interfaces.pop(interface_name, None)
+        if prefix is None:
+            return
+
+        # add_interface assigns the remaining prefixes again
+        remaining = list(self.interfaces.items())
+        self.interfaces.clear()
+        self.assigned_prefixes.clear()
+
+        if self.config_stream is not None:
+            self.config_stream.seek(0)
+            self.config_stream.truncate()
+        else:
+            os.chmod(self.config_file, 0o600)
+            with open(self.config_file, 'wt') as f:
+                f.write('')
+
+        with self.bulk_edit():
+            for name, prefix in remaining:
+                self.add_interface(name, prefix)
+
+    @contextmanager
+    def bulk_edit(self) -> Iterator[None]:
+        """Add several interfaces while opening the config file and
+        changing its permissions only once"""
+        if self._bulk_file:
+            # already inside of a bulk edit
+            yield
+            return
+
+        if self.config_stream is not None:
+            self._bulk_file = self.config_stream
+            try:
+                yield
+            finally:
+                self._bulk_file = None
+            return
+
         # Radvd forces us to have read-only permissions on the file.
         # To be able to edit it, we have to alter permissions and change them
         # back after our changes
         os.chmod(self.config_file, 0o600)
 
-        with open(self.config_file, 'at') as f:
-            f.write('\n\n' + config_block)
-
-        self.assigned_prefixes.add(prefix)
-
-        os.chmod(self.config_file, 0o400)
+        try:
+            with open(self.config_file, 'at') as f:
+                self._bulk_file = f
+                yield
+        finally:
+            self._bulk_file = None
+            os.chmod(self.config_file, 0o400)
 
     def get_start_command(self):
         pidfile = Path(tempfile.gettempdir()) / 'radvd.pid'
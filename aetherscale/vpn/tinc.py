@@ -1,17 +1,64 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import cached_property
 import logging
 import os
 from pathlib import Path
 import re
 import shlex
-import shutil
 import subprocess
 import tempfile
-from typing import Optional
+from typing import Iterator, List, Optional, Set, Tuple
 
 from aetherscale import config
 from aetherscale.services import ServiceManager
 
 
+# valid names for tinc networks and hosts
+_NAME_RE = re.compile(r'[a-z0-9]+\Z')
+# directories that are known to exist, saves a mkdir per peer or config write;
+# another process may remove them, so writes recover from stale entries
+_ensured_dirs: Set[Path] = set()
+
+
+def _ensure_dir(path: Path, force: bool = False):
+    if force or path not in _ensured_dirs:
+        path.mkdir(parents=True, exist_ok=True)
+        _ensured_dirs.add(path)
+
+
+def _write_small_file(
+        path: Path, content: bytes, mode: int = 0o644, append: bool = False):
+    """Write a small file with a single unbuffered write"""
+    flags = os.O_WRONLY | os.O_CREAT
+    flags |= os.O_APPEND if append else os.O_TRUNC
+
+    try:
+        fd = os.open(path, flags, mode)
+    except FileNotFoundError:
+        # the directory was removed, e.g. by a teardown in another process
+        _ensure_dir(path.parent, force=True)
+        fd = os.open(path, flags, mode)
+
+    try:
+        os.write(fd, content)
+    finally:
+        os.close(fd)
+
+
+def _fast_rmtree(path: str):
+    """Remove the shallow tinc config tree. The entry types from scandir
+    are used directly, so no stat call per file is needed."""
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                _fast_rmtree(entry.path)
+            else:
+                os.unlink(entry.path)
+
+    os.rmdir(path)
+
+
 class VpnException(Exception):
     pass
 
@@ -30,7 +77,7 @@ class TincVirtualNetwork(object):
         self.pidfile = Path(tempfile.gettempdir()) / f'tincd-{self.netname}.run'
 
     def network_exists(self) -> bool:
-        return self._net_config_folder().is_dir()
+        return self.net_config_folder.is_dir()
 
     @property
     def interface_name(self):
@@ -41,101 +88,121 @@ class TincVirtualNetwork(object):
         return f'tincbr-{self.netname}'
 
     def create_config(self, hostname: str):
-        if not re.match('^[a-z0-9]+$', hostname):
+        if not _NAME_RE.match(hostname):
             raise ValueError(f'Invalid hostname provided ("{hostname}")')
 
-        config_dir = self._net_config_folder()
-        config_dir.mkdir(parents=True, exist_ok=True)
+        config_dir = self.net_config_folder
+        _ensure_dir(config_dir)
 
-        with open(config_dir / 'tinc.conf', 'w') as f:
-            lines = [
-                f'Name = {hostname}\n',
-                'Mode = switch\n',
-                f'Interface = {self.interface_name}\n',
-                f'Port = {self.port}\n',
-            ]
-            f.writelines(lines)
+        _write_small_file(
+            config_dir / 'tinc.conf',
+            f'Name = {hostname}\n'
+            'Mode = switch\n'
+            f'Interface = {self.interface_name}\n'
+            f'Port = {self.port}\n'.encode('ascii'))
 
         self._create_host(hostname, public_ip=None, pubkey=None)
 
     def add_peer(self, hostname: str, public_ip: str, pubkey: str):
-        self._create_host(hostname, public_ip, pubkey)
+        self.add_peers([(hostname, public_ip, pubkey)])
+
+    def add_peers(self, peers: List[Tuple[str, str, str]]):
+        """Add several peers, takes tuples of hostname, public IP and public
+        key"""
+        for hostname, public_ip, pubkey in peers:
+            self._create_host(hostname, public_ip, pubkey)
 
-        with open(self._net_config_folder() / 'tinc.conf', 'a') as f:
-            f.write(f'ConnectTo = {hostname}')
+        connect_lines = ''.join(
+            f'ConnectTo = {hostname}\n' for hostname, _, _ in peers)
+        _write_small_file(
+            self.net_config_folder / 'tinc.conf',
+            connect_lines.encode('ascii'), append=True)
 
     def _create_host(
             self, hostname: str, public_ip: Optional[str],
             pubkey: Optional[str]):
-        hosts_dir = self._net_config_folder() / 'hosts'
-        os.makedirs(hosts_dir, exist_ok=True)
-
-        with open(hosts_dir / hostname, 'w') as f:
-            if public_ip:
-                f.write(f'Address = {public_ip}\n')
+        hosts_dir = self.net_config_folder / 'hosts'
+        _ensure_dir(hosts_dir)
 
-            if pubkey:
-                f.write('\n')
-                f.write(pubkey)
+        address_line = f'Address = {public_ip}\n' if public_ip else ''
+        pubkey_block = f'\n{pubkey}' if pubkey else ''
+        _write_small_file(
+            hosts_dir / hostname,
+            (address_line + pubkey_block).encode('ascii'))
 
     def gen_keypair(self):
+        with self.gen_keypair_async():
+            pass
+        logging.debug('Finished generating key pair')
+
+    @contextmanager
+    def gen_keypair_async(self) -> Iterator[None]:
+        """Generate the key pair in the background while the block runs. The
+        key generation is always waited for when the block is left, and a
+        failed generation raises a VpnException."""
         logging.debug('Generating key pair for tinc')
-        subprocess.run(
-            ['tincd', '-K', '-c', self._net_config_folder()],
+        process = subprocess.Popen(
+            ['tincd', '-K', '-c', self.net_config_folder],
             stdin=subprocess.DEVNULL)
-        logging.debug('Finished generating key pair')
+
+        try:
+            yield
+        finally:
+            returncode = process.wait()
+
+        if returncode != 0:
+            raise VpnException(
+                f'Could not generate key pair for VPN "{self.netname}"')
 
     def _validate_netname(self, netname: str):
-        if not re.match('^[a-z0-9]+$', netname):
-            return False
+        # the length check is cheaper, run it first
         if len(netname) > 8:
             return False
 
-        return True
+        return _NAME_RE.match(netname) is not None
 
-    def _net_config_folder(self) -> Path:
+    @cached_property
+    def net_config_folder(self) -> Path:
         return config.AETHERSCALE_CONFIG_DIR / 'vpn' / self.netname / 'tinc'
 
-    def _service_name(self) -> str:
+    @cached_property
+    def service_name(self) -> str:
         return f'aetherscale-tincd-{self.netname}.service'
 
     def start_daemon(
             self, setup_network_script: str, teardown_network_script: str):
-        net_dir_quoted = shlex.quote(str(self._net_config_folder()))
+        net_dir_quoted = shlex.quote(str(self.net_config_folder))
         pidfile_quoted = shlex.quote(str(self.pidfile))
 
         # TODO: Manage all paths through a central module responsible for
         # path/files management
         network_conf_dir = config.AETHERSCALE_CONFIG_DIR / 'vpn' / self.netname
-        network_conf_dir.mkdir(parents=True, exist_ok=True)
+        _ensure_dir(network_conf_dir)
         setup_file = network_conf_dir / f'network-{self.netname}-setup.sh'
         teardown_file = network_conf_dir / f'network-{self.netname}-teardown.sh'
-        with open(setup_file, 'w') as f:
-            f.write(setup_network_script)
-            os.chmod(setup_file, 0o755)
-        with open(teardown_file, 'w') as f:
-            f.write(teardown_network_script)
-            os.chmod(teardown_file, 0o755)
-
-        service_name = self._service_name()
-        with tempfile.NamedTemporaryFile('wt') as f:
-            f.write('[Unit]\n')
-            f.write(f'Description=aetherscale {self.netname} VPN with tincd\n')
-            f.write('\n')
-            f.write('[Service]\n')
-            f.write(f'ExecStartPre={setup_file.absolute()}\n')
-            f.write(
-                f'ExecStart=tincd -D -c {net_dir_quoted} '
-                f'--pidfile {pidfile_quoted}\n')
-            f.write(f'ExecStopPost={teardown_file.absolute()}\n')
-            f.write('\n')
-            f.write('[Install]\n')
-            f.write('WantedBy=default.target\n')
-
-            f.flush()
-
-            logging.debug(f'Installing tinc VPN service "{service_name}"')
-            self.service_manager.install_service(Path(f.name), service_name)
+        _write_small_file(
+            setup_file, setup_network_script.encode('utf-8'), mode=0o755)
+        _write_small_file(
+            teardown_file, teardown_network_script.encode('utf-8'),
+            mode=0o755)
+
+        service_name = self.service_name
+        unit = (
+            '[Unit]\n'
+            f'Description=aetherscale {self.netname} VPN with tincd\n'
+            '\n'
+            '[Service]\n'
+            f'ExecStartPre={setup_file.absolute()}\n'
+            f'ExecStart=tincd -D -c {net_dir_quoted} '
+            f'--pidfile {pidfile_quoted}\n'
+            f'ExecStopPost={teardown_file.absolute()}\n'
+            '\n'
+            '[Install]\n'
+            'WantedBy=default.target\n'
+        )
+
+        logging.debug(f'Installing tinc VPN service "{service_name}"')
+        self.service_manager.install_service_contents(unit, service_name)
 
         self.service_manager.enable_service(service_name)
         success = self.service_manager.start_service(service_name)
@@ -143,5 +210,27 @@ class TincVirtualNetwork(object):
             raise VpnException(f'Could not establish VPN "{self.netname}"')
 
     def teardown_tinc_config(self):
-        self.service_manager.uninstall_service(self._service_name())
-        shutil.rmtree(self._net_config_folder())
+        self.service_manager.uninstall_service(self.service_name)
+        _fast_rmtree(str(self.net_config_folder))
+
+        # the removed directories have to be created again by a new config
+        for path in list(_ensured_dirs):
+            if path == self.net_config_folder \
+                    or self.net_config_folder in path.parents:
+                _ensured_dirs.discard(path)
+
+
+def bulk_start(vpns: List[Tuple[TincVirtualNetwork, str, str]]):
+    """Start several VPNs in parallel, takes tuples of the network, its
+    setup script and its teardown script. Starting a VPN mostly waits for
+    file writes and systemd, so threads suffice."""
+    if not vpns:
+        return
+
+    def start(args: Tuple[TincVirtualNetwork, str, str]):
+        vpn, setup_network_script, teardown_network_script = args
+        vpn.start_daemon(setup_network_script, teardown_network_script)
+
+    with ThreadPoolExecutor(max_workers=min(32, len(vpns))) as executor:
+        # consume the results to re-raise the first VpnException
+        list(executor.map(start, vpns))
@@ -1,21 +1,20 @@
 #!/usr/bin/env python
 
 import jinja2
-from pathlib import Path
 import sys
-import tempfile
-import time
 from typing import List
 
 from aetherscale.client import ServerCommunication
 import aetherscale.config
-from aetherscale.timing import timeout
+from aetherscale.timing import check_deadline, timeout
 
 
-def create_vm(init_script: Path, comm: ServerCommunication) -> str:
-    with open(init_script) as f:
-        script = f.read()
+# seconds between two lookups of the VM's IP address, doubled after each try
+IP_POLL_INITIAL_DELAY = 0.25
+IP_POLL_MAX_DELAY = 5.0
 
+
+def create_vm(script: str, comm: ServerCommunication) -> str:
     responses = comm.send_msg({
         'command': 'create-vm',
         'options': {
@@ -39,63 +38,70 @@ def create_vm(init_script: Path, comm: ServerCommunication) -> str:
 
 
 def get_vm_ips(vm_id: str, comm: ServerCommunication) -> List[str]:
+    # a single host answers, no need to wait for the timeout
     responses = comm.send_msg({
         'command': 'list-vms',
-    }, response_expected=True)
+    }, response_expected=True, expected_responses=1)
 
     for r in responses:
         try:
             for vm in r['response']:
                 if vm['vm-id'] == vm_id:
                     return vm['ip-addresses']
-        except KeyError:
+        except (KeyError, TypeError):
+            # error responses have no VM list
             pass
 
     return []
 
 
+def wait_for_vpn_ip(vm_id: str, comm: ServerCommunication) -> str:
+    # TODO: Currently, the VM image has a flaw in setup of IP addresses
+    # it will wait for a DHCP to be available on all interfaces, but
+    # VPN interface does not have this. To make this work with all
+    # variants of vpn/public-ip we have to define fixed interface names
+    # with https://www.freedesktop.org/software/systemd/man/systemd.link.html
+    # and then can set the right IP lookup for each interface in
+    # /etc/systemd/network/
+    # or we can omit the fixed interface names and directly match on the
+    # MAC address in .network files
+    # (both variants have to be copied to the image before booting it)
+    with timeout(300):
+        delay = IP_POLL_INITIAL_DELAY
+
+        while True:
+            check_deadline()
+
+            ips = get_vm_ips(vm_id, comm)
+            vpn_prefix = aetherscale.config.VPN_48_PREFIX
+            vpn_ips = [ip for ip in ips if ip.startswith(vpn_prefix)]
+
+            if len(vpn_ips) > 0:
+                return vpn_ips[0]
+
+            # unlike time.sleep this keeps the AMQP connection alive
+            comm.connection.sleep(delay)
+            delay = min(delay * 2, IP_POLL_MAX_DELAY)
+
+
 def main():
     env = jinja2.Environment(loader=jinja2.FileSystemLoader('./'))
     template = env.get_template('jitsi-install.sh.jinja2')
 
-    with tempfile.NamedTemporaryFile('wt') as f:
-        template.stream(hostname='jitsi.example.com').dump(f.name)
-
-        with ServerCommunication() as comm:
-            try:
-                vm_id = create_vm(Path(f.name), comm)
-            except RuntimeError as e:
-                print(str(e), file=sys.stderr)
-                sys.exit(1)
-
-    try:
-        # TODO: Currently, the VM image has a flaw in setup of IP addresses
-        # it will wait for a DHCP to be available on all interfaces, but
-        # VPN interface does not have this. To make this work with all
-        # variants of vpn/public-ip we have to define fixed interface names
-        # with https://www.freedesktop.org/software/systemd/man/systemd.link.html
-        # and then can set the right IP lookup for each interface in
-        # /etc/systemd/network/
-        # or we can omit the fixed interface names and directly match on the
-        # MAC address in .network files
-        # (both variants have to be copied to the image before booting it)
-        with timeout(300):
-            ip_address = None
-
-            while not ip_address:
-                with ServerCommunication() as comm:
-                    ips = get_vm_ips(vm_id, comm)
-                    vpn_prefix = aetherscale.config.VPN_48_PREFIX
-                    vpn_ips = [ip for ip in ips if ip.startswith(vpn_prefix)]
-
-                    if len(vpn_ips) > 0:
-                        ip_address = vpn_ips[0]
-
-                time.sleep(5)
-
-        print(ip_address)
-    except TimeoutError:
-        print('Could not retrieve IP address', file=sys.stderr)
+    script = template.render(hostname='jitsi.example.com')
+
+    # one connection for creating the VM and polling for its IP address
+    with ServerCommunication() as comm:
+        try:
+            vm_id = create_vm(script, comm)
+        except RuntimeError as e:
+            print(str(e), file=sys.stderr)
+            sys.exit(1)
+
+        try:
+            print(wait_for_vpn_ip(vm_id, comm))
+        except TimeoutError:
+            print('Could not retrieve IP address', file=sys.stderr)
 
 
 if __name__ == '__main__':
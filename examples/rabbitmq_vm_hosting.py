@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 
+import ipaddress
 import sys
-import time
 from typing import List
 
 from aetherscale.client import ServerCommunication
@@ -27,47 +27,48 @@ def create_rabbitmq_vm(comm: ServerCommunication) -> str:
 
 
 def get_vm_ips(vm_id: str, comm: ServerCommunication) -> List[str]:
+    # a single host answers, no need to wait for the timeout
     responses = comm.send_msg({
         'command': 'list-vms',
-    }, response_expected=True)
+    }, response_expected=True, expected_responses=1)
 
     for r in responses:
         try:
             for vm in r['response']:
                 if vm['vm-id'] == vm_id:
                     return vm['ip-addresses']
-        except KeyError:
+        except (KeyError, TypeError):
+            # error responses have no VM list
             pass
 
     return []
 
 
 def is_external_ip(ip: str) -> bool:
-    """Quick hack to check whether an IP returned by list-vms is an
-    external IP address"""
-    if ':' in ip:
-        first_part = ip.split(':')[0]
-
-        try:
-            if int('fe80', 16) <= int(first_part, 16) <= int('febf', 16):
-                # link-local
-                return False
-        except ValueError:
-            # if it cannot be parsed as hex, it's not in range
-            return False
-
-    if ip == '::1' or ip == '127.0.0.1':
-        # localhost
+    """Check whether an IP returned by list-vms is an external IP address,
+    i.e. neither a loopback nor a link-local address"""
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
         return False
 
-    return True
+    return not (address.is_loopback or address.is_link_local)
+
 
+def management_urls(ips: List[str]) -> List[str]:
+    """URLs of the RabbitMQ management interface on all external IPs"""
+    urls = []
 
-def format_ip_for_url(ip: str) -> str:
-    if ':' in ip:
-        return f'[{ip}]'
-    else:
-        return ip
+    for ip in ips:
+        if not is_external_ip(ip):
+            continue
+
+        if ':' in ip:
+            urls.append(f'http://[{ip}]:15672/')
+        else:
+            urls.append(f'http://{ip}:15672/')
+
+    return urls
 
 
 def main():
@@ -78,17 +79,11 @@ def main():
             print(str(e), file=sys.stderr)
             sys.exit(1)
 
-    time.sleep(30)
-    # TODO: There seems to be a bug in ServerCommunication so that we can only
-    # exchange one message pair per context
-    # Probably related to the AMQ reply-to channel
-    with ServerCommunication() as comm:
+        # sleep on the connection, so that it keeps answering heartbeats
+        comm.connection.sleep(30)
         ips = get_vm_ips(vm_id, comm)
 
-    ips = [f'http://{format_ip_for_url(ip)}:15672/' for ip in ips
-           if is_external_ip(ip)]
-
-    print(ips)
+    print(management_urls(ips))
 
 
 if __name__ == '__main__':
@@ -1,10 +1,16 @@
 import re
 from setuptools import setup
 
-version = re.search(
-    r'^__version__\s*=\s*\'(.+)\'',
-    open('aetherscale/__init__.py').read(),
-    re.M).group(1)
+version_re = re.compile(r'^__version__\s*=\s*\'(.+)\'')
+
+with open('aetherscale/__init__.py') as f:
+    for line in f:
+        match = version_re.match(line)
+        if match:
+            version = match.group(1)
+            break
+    else:
+        raise RuntimeError('Could not find __version__ in aetherscale')
 
 with open('README.md', 'rb') as f:
     long_descr = f.read().decode('utf-8')
@@ -30,6 +36,10 @@ setup(
         ],
     },
     install_requires=install_requires,
+    extras_require={
+        # control systemd over D-Bus instead of systemctl
+        'dbus': ['pystemd'],
+    },
     version=version,
     description='Proof-of-concept for a small cloud computing platform',
     long_description=long_descr,
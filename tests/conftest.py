@@ -1,84 +1,112 @@
+from contextlib import contextmanager
 from pathlib import Path
 import pytest
-from typing import Optional, List
+import re
+import signal
+import tempfile
+from typing import Dict, NamedTuple, Optional, List
+from unittest import mock
 
 from aetherscale.services import ServiceManager
-import aetherscale.timing
+
+
+@pytest.fixture(scope='module')
+def _tmproot(tmp_path_factory) -> Path:
+    return tmp_path_factory.mktemp('aether')
+
+
+@pytest.fixture
+def tmppath(_tmproot: Path, request) -> Path:
+    # one directory per test inside a root that is shared by the module,
+    # pytest removes old roots itself; parametrize ids can contain slashes
+    # and the same name can run twice, so the name is only a prefix
+    prefix = re.sub(r'[^\w.-]', '_', request.node.name)[:30]
+    return Path(tempfile.mkdtemp(prefix=f'{prefix}-', dir=_tmproot))
 
 
 @pytest.fixture
-def tmppath(tmpdir):
-    yield Path(tmpdir)
+def config_dir(tmppath: Path) -> Path:
+    """Redirect the aetherscale config dir so that tests never write to the
+    user's home directory"""
+    with mock.patch('aetherscale.config.AETHERSCALE_CONFIG_DIR', tmppath):
+        yield tmppath
 
 
 @pytest.fixture
 def timeout():
-    return aetherscale.timing.timeout
+    @contextmanager
+    def timeout_function(seconds: float):
+        """Fail a test block with a TimeoutError if it does not finish in
+        time. Unlike aetherscale.timing.timeout this interrupts blocking
+        calls, but only works in the main thread."""
+        def raise_exception(signum, frame):
+            raise TimeoutError
+
+        previous_handler = signal.signal(signal.SIGALRM, raise_exception)
+        signal.setitimer(signal.ITIMER_REAL, seconds)
+        try:
+            yield None
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous_handler)
+
+    return timeout_function
+
+
+class ServiceState(NamedTuple):
+    installed: bool = False
+    started: bool = False
+    enabled: bool = False
 
 
 @pytest.fixture
 def mock_service_manager():
     class MockServiceManager(ServiceManager):
         def __init__(self):
-            self.services = set()
-            self.started_services = set()
-            self.enabled_services = set()
+            self.state: Dict[str, ServiceState] = {}
 
-        def install_service(self, config_file: Path, service_name: str) -> bool:
-            self.services.add(service_name)
+        def _update(self, service_name: str, **changes: bool) -> bool:
+            state = self.state.get(service_name, ServiceState())
+            self.state[service_name] = state._replace(**changes)
             return True
 
+        def install_service(self, config_file: Path, service_name: str) -> bool:
+            return self._update(service_name, installed=True)
+
         def install_simple_service(
                 self, command: str, service_name: str,
                 description: Optional[str] = None) -> bool:
-            self.services.add(service_name)
-            return True
+            return self._update(service_name, installed=True)
 
         def uninstall_service(self, service_name: str) -> bool:
-            try:
-                self.services.remove(service_name)
-            except KeyError:
-                # should not fail if was already uninstalled
-                pass
-
-            return True
+            # should not fail if was already uninstalled
+            return self._update(service_name, installed=False)
 
         def start_service(self, service_name: str) -> bool:
-            self.started_services.add(service_name)
-            return True
+            return self._update(service_name, started=True)
 
         def stop_service(self, service_name: str) -> bool:
-            try:
-                self.started_services.remove(service_name)
-            except KeyError:
-                # should not fail if was already stopped
-                pass
-
-            return True
+            # should not fail if was already stopped
+            return self._update(service_name, started=False)
 
         def restart_service(self, service_name: str) -> bool:
             return True
 
         def enable_service(self, service_name: str) -> bool:
-            self.enabled_services.add(service_name)
-            return True
+            return self._update(service_name, enabled=True)
 
         def disable_service(self, service_name: str) -> bool:
-            try:
-                self.enabled_services.remove(service_name)
-            except KeyError:
-                # should not fail if was already disabled
-                pass
-
-            return True
+            # should not fail if was already disabled
+            return self._update(service_name, enabled=False)
 
         def service_is_running(self, service_name: str) -> bool:
-            return service_name in self.started_services
+            return self.state.get(service_name, ServiceState()).started
 
         def service_exists(self, service_name: str) -> bool:
-            return service_name in self.services
+            return self.state.get(service_name, ServiceState()).installed
 
         def list_services(self) -> List[str]:
-            return self.services
+            return [
+                name for name, state in self.state.items() if state.installed]
 
     return MockServiceManager()
@@ -0,0 +1,30 @@
+import json
+
+from aetherscale.api import broker
+
+
+def test_status_response_matches_json_encoding():
+    response = {'status': 'starting', 'vm-id': 'abcdef12'}
+    expected = {
+        'execution-info': {
+            'status': 'success'
+        },
+        'response': response,
+    }
+
+    encoded = broker.encode_success_response(response)
+    assert encoded == json.dumps(expected).encode('utf-8')
+
+
+def test_response_with_special_characters_is_escaped():
+    response = {'status': 'starting', 'vm-id': 'abc"def'}
+
+    encoded = broker.encode_success_response(response)
+    assert json.loads(encoded)['response'] == response
+
+
+def test_other_responses_are_json_encoded():
+    response = [{'vm-id': 'abcdef12', 'ip-addresses': ['10.0.0.1']}]
+
+    encoded = broker.encode_success_response(response)
+    assert json.loads(encoded)['response'] == response
@@ -76,3 +76,16 @@ def test_stop_vm(handler, client):
     # missing message must lead to error
     rv = client.patch('/vm/my-vm-id')
     assert rv.status_code == 400
+
+
+@mock.patch('aetherscale.services.create_service_manager')
+@mock.patch('aetherscale.api.rest.ComputingHandler')
+def test_service_manager_is_shared(handler, create_service_manager, client):
+    aetherscale.api.rest.get_service_manager.cache_clear()
+    handler.return_value.list_vms.return_value = [[]]
+
+    client.get('/vm')
+    client.get('/vm')
+
+    create_service_manager.assert_called_once()
+    aetherscale.api.rest.get_service_manager.cache_clear()
@@ -0,0 +1,45 @@
+import json
+from unittest import mock
+
+from aetherscale import client
+
+
+def deliver(comm, correlation_id, response):
+    properties = mock.Mock(correlation_id=correlation_id)
+    comm.on_response(
+        comm.channel, None, properties, json.dumps(response).encode('utf-8'))
+
+
+@mock.patch('pika.BlockingConnection')
+def test_late_responses_are_dropped(connection_class):
+    with client.ServerCommunication() as comm:
+        def start_consuming():
+            # reply to an earlier message that arrived after its timeout
+            deliver(comm, 'earlier-message', {'response': {'vm-id': 'a'}})
+            deliver(comm, comm.correlation_id, {'response': []})
+
+        comm.channel.start_consuming.side_effect = start_consuming
+
+        responses = comm.send_msg(
+            {'command': 'list-vms'}, response_expected=True)
+
+    assert responses == [{'response': []}]
+    properties = comm.channel.basic_publish.call_args[1]['properties']
+    assert properties.correlation_id == comm.correlation_id
+
+
+@mock.patch('pika.BlockingConnection')
+def test_stop_consuming_after_expected_responses(connection_class):
+    with client.ServerCommunication() as comm:
+        comm.channel.start_consuming.side_effect = \
+            lambda: deliver(comm, comm.correlation_id, {'response': []})
+
+        comm.send_msg(
+            {'command': 'list-vms'}, response_expected=True,
+            expected_responses=1)
+
+    comm.channel.stop_consuming.assert_called_once()
+    # the timeout must not stop consuming for the next message
+    connection = connection_class.return_value
+    connection.remove_timeout.assert_called_once_with(
+        connection.call_later.return_value)
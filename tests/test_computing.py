@@ -1,99 +1,442 @@
+import contextlib
 from contextlib import contextmanager
 import os
 from pathlib import Path
 import pytest
+import shutil
+import stat
+import struct
 import subprocess
+import threading
+import types
 from typing import Iterator
 from unittest import mock
 import uuid
 
 from aetherscale import computing
+from aetherscale.qemu.exceptions import QemuException
 from aetherscale.services import ServiceManager
+from aetherscale.vpn.tinc import TincVirtualNetwork, VpnException
+
+
+# only the parts of Radvd that ComputingHandler uses
+FAKE_RADVD = types.SimpleNamespace(
+    generate_prefix=lambda: '2001:db8::/64',
+    add_interface=lambda interface, prefix: None,
+    remove_interface=lambda interface: None,
+    interfaces={},
+)
+
+
+# magic, version, backing file offset and size, cluster bits, virtual size,
+# crypt method, L1 size and offset, refcount table offset and clusters,
+# number of snapshots and offset, incompatible, compatible and autoclear
+# features, refcount order, header length
+QCOW2_HEADER = struct.Struct('>4sIQIIQIIQQIIQQQQII')
+
+
+def _make_stub_qcow2(path: Path, size: int = 1 << 30):
+    """Write an empty qcow2 v3 image with the same layout as qemu-img create:
+    header, refcount table, refcount block and L1 table in one cluster
+    each"""
+    cluster_size = 1 << 16
+    refcount_table_offset = cluster_size
+    refcount_block_offset = 2 * cluster_size
+    l1_table_offset = 3 * cluster_size
+
+    # each L2 table maps cluster_size / 8 clusters
+    l2_coverage = cluster_size // 8 * cluster_size
+    l1_size = (size + l2_coverage - 1) // l2_coverage
+
+    header = QCOW2_HEADER.pack(
+        b'QFI\xfb', 3, 0, 0, 16, size, 0, l1_size, l1_table_offset,
+        refcount_table_offset, 1, 0, 0, 0, 0, 0, 4, QCOW2_HEADER.size)
+
+    with open(path, 'wb') as f:
+        # the header extension area stays zero, which marks its end
+        f.write(header)
+        f.seek(refcount_table_offset)
+        f.write(struct.pack('>Q', refcount_block_offset))
+        # 16 bit refcounts for the four used clusters
+        f.seek(refcount_block_offset)
+        f.write(struct.pack('>4H', 1, 1, 1, 1))
+        # all L1 entries are zero, i.e. no cluster is allocated yet
+        os.ftruncate(f.fileno(), l1_table_offset + 8 * l1_size)
+
+
+@pytest.fixture(scope='session')
+def qcow2_template(tmp_path_factory) -> Path:
+    """An empty qcow2 image, created only once for all tests"""
+    img_file = tmp_path_factory.mktemp('images') / 'template.qcow2'
+    _make_stub_qcow2(img_file)
+    return img_file
 
 
 @contextmanager
-def base_image(directory: Path) -> Iterator[Path]:
+def base_image(directory: Path, template: Path) -> Iterator[Path]:
+    # no cleanup, the image is removed together with the test's directory
     random_name = str(uuid.uuid4())
     img_file = directory / f'{random_name}.qcow2'
+
+    # tests never write to base images, so they can share the template
     try:
-        subprocess.run([
-            'qemu-img', 'create', '-f', 'qcow2', str(img_file), '1G'])
-        yield img_file
-    finally:
-        os.unlink(img_file)
-
-
-def test_create_user_image(tmppath):
-    with mock.patch('aetherscale.config.BASE_IMAGE_FOLDER', tmppath), \
-            mock.patch('aetherscale.config.USER_IMAGE_FOLDER', tmppath):
-
-        with base_image(tmppath) as img:
-            user_image = computing.create_user_image('my-vm-id', img.stem)
-            user_image.is_file()
-
-
-def test_vm_lifecycle(tmppath, mock_service_manager: ServiceManager):
-    with mock.patch('aetherscale.config.BASE_IMAGE_FOLDER', tmppath), \
-            mock.patch('aetherscale.config.USER_IMAGE_FOLDER', tmppath):
-
-        handler = computing.ComputingHandler(
-            radvd=mock.MagicMock(), service_manager=mock_service_manager)
-
-        with base_image(tmppath) as img:
-            results = list(handler.create_vm({'image': img.stem}))
-            list_results = list(handler.list_vms({}))
-            vm_id = results[0]['vm-id']
-            service_name = computing.systemd_unit_name_for_vm(vm_id)
-            assert results[0]['status'] == 'allocating'
-            assert results[1]['status'] == 'starting'
-            assert mock_service_manager.service_is_running(service_name)
-            assert list_results[0][0]['vm-id'] == vm_id
-
-            vm_info = list(handler.vm_info({'vm-id': vm_id}))[0]
-            assert vm_info['vm-id'] == vm_id
-            assert vm_info['status'] == 'running'
-
-            # TODO: Test graceful stop, needs mock of QemuMonitor
-            results = list(handler.stop_vm({'vm-id': vm_id, 'kill': True}))
-            list_results = list(handler.list_vms({}))
-            assert results[0]['status'] == 'killed'
-            assert mock_service_manager.service_exists(service_name)
-            assert not mock_service_manager.service_is_running(service_name)
-            assert list_results[0][0]['vm-id'] == vm_id
-
-            results = list(handler.start_vm({'vm-id': vm_id}))
-            list_results = list(handler.list_vms({}))
-            assert results[0]['status'] == 'starting'
-            assert mock_service_manager.service_exists(service_name)
-            assert mock_service_manager.service_is_running(service_name)
-            assert list_results[0][0]['vm-id'] == vm_id
-
-            results = list(handler.delete_vm({'vm-id': vm_id}))
-            list_results = list(handler.list_vms({}))
-            assert results[0]['status'] == 'deleted'
-            assert not mock_service_manager.service_exists(service_name)
-            assert not mock_service_manager.service_is_running(service_name)
-            assert len(list_results[0]) == 0
-
-
-def test_run_missing_base_image(tmppath, mock_service_manager: ServiceManager):
-    with mock.patch('aetherscale.config.BASE_IMAGE_FOLDER', tmppath), \
-             mock.patch('aetherscale.config.USER_IMAGE_FOLDER', tmppath):
-
-        handler = computing.ComputingHandler(
-            radvd=mock.MagicMock(), service_manager=mock_service_manager)
-
-        # specify invalid base image
+        os.link(template, img_file)
+    except OSError:
+        shutil.copyfile(template, img_file)
+
+    yield img_file
+
+
+def test_create_user_image(tmppath, qcow2_template):
+    with base_image(tmppath, qcow2_template) as img:
+        user_image = computing.create_user_image(
+            'my-vm-id', img.stem, tmppath, tmppath)
+        user_image.is_file()
+
+
+def test_vm_lifecycle(
+        tmppath, config_dir, qcow2_template,
+        mock_service_manager: ServiceManager):
+    handler = computing.ComputingHandler(
+        radvd=FAKE_RADVD, service_manager=mock_service_manager,
+        base_image_folder=tmppath, user_image_folder=tmppath)
+
+    with base_image(tmppath, qcow2_template) as img:
+        results = list(handler.create_vm({'image': img.stem}))
+        list_results = list(handler.list_vms({}))
+        vm_id = results[0]['vm-id']
+        service_name = computing.systemd_unit_name_for_vm(vm_id)
+        assert results[0]['status'] == 'allocating'
+        assert results[1]['status'] == 'starting'
+        assert mock_service_manager.service_is_running(service_name)
+        assert list_results[0][0]['vm-id'] == vm_id
+
+        vm_info = list(handler.vm_info({'vm-id': vm_id}))[0]
+        assert vm_info['vm-id'] == vm_id
+        assert vm_info['status'] == 'running'
+
+        # TODO: Test graceful stop, needs mock of QemuMonitor
+        results = list(handler.stop_vm({'vm-id': vm_id, 'kill': True}))
+        list_results = list(handler.list_vms({}))
+        assert results[0]['status'] == 'killed'
+        assert mock_service_manager.service_exists(service_name)
+        assert not mock_service_manager.service_is_running(service_name)
+        assert list_results[0][0]['vm-id'] == vm_id
+
+        results = list(handler.start_vm({'vm-id': vm_id}))
+        list_results = list(handler.list_vms({}))
+        assert results[0]['status'] == 'starting'
+        assert mock_service_manager.service_exists(service_name)
+        assert mock_service_manager.service_is_running(service_name)
+        assert list_results[0][0]['vm-id'] == vm_id
+
+        results = list(handler.delete_vm({'vm-id': vm_id}))
+        list_results = list(handler.list_vms({}))
+        assert results[0]['status'] == 'deleted'
+        assert not mock_service_manager.service_exists(service_name)
+        assert not mock_service_manager.service_is_running(service_name)
+        assert len(list_results[0]) == 0
+
+
+@mock.patch('aetherscale.qemu.runtime.QemuMonitor')
+def test_graceful_stop_closes_qmp_connection(
+        monitor_class, tmppath, config_dir,
+        mock_service_manager: ServiceManager):
+    handler = computing.ComputingHandler(
+        radvd=FAKE_RADVD, service_manager=mock_service_manager,
+        user_image_folder=tmppath)
+
+    service_name = computing.systemd_unit_name_for_vm('myvmid')
+    mock_service_manager.install_simple_service('qemu', service_name)
+
+    for _ in range(2):
+        mock_service_manager.start_service(service_name)
+        results = list(handler.stop_vm({'vm-id': 'myvmid'}))
+        assert results[0]['status'] == 'stopped'
+
+    # QEMU serves one QMP client at a time, no connection is kept open
+    qmp = monitor_class.return_value
+    assert monitor_class.call_count == 2
+    assert monitor_class.call_args[1]['timeout'] == computing.QMP_TIMEOUT
+    assert qmp.execute.call_args_list == [mock.call('system_powerdown')] * 2
+    assert qmp.close.call_count == 2
+
+
+def test_run_missing_base_image(
+        tmppath, config_dir, mock_service_manager: ServiceManager):
+    handler = computing.ComputingHandler(
+        radvd=FAKE_RADVD, service_manager=mock_service_manager,
+        base_image_folder=tmppath, user_image_folder=tmppath)
+
+    # specify invalid base image
+    with pytest.raises(OSError):
+        # make sure to exhaust the iterator
+        list(handler.create_vm({'image': 'some-missing-image'}))
+
+    # no VPN is set up for a VM that cannot be created
+    with mock.patch.object(handler, '_establish_vpn') as establish_vpn:
         with pytest.raises(OSError):
-            # make sure to exhaust the iterator
-            list(handler.create_vm({'image': 'some-missing-image'}))
+            list(handler.create_vm(
+                {'image': 'some-missing-image', 'vpn': 'myvpn'}))
+    establish_vpn.assert_not_called()
+    assert mock_service_manager.list_services() == []
+
+    # do not specify a base image
+    with pytest.raises(ValueError):
+        # make sure to exhaust the iterator
+        list(handler.create_vm({}))
+
+
+def test_tap_scripts_follow_config_dir(config_dir):
+    computing.install_tap_scripts()
+
+    assert computing.setup_script_path().parent == config_dir / 'networking'
+    assert os.access(computing.setup_script_path(), os.X_OK)
+    assert os.access(computing.teardown_script_path(), os.X_OK)
+
+
+@pytest.mark.parametrize('device_exists', [True, False])
+def test_tap_teardown_only_deletes_created_device(
+        tmppath, config_dir, device_exists):
+    bin_dir = tmppath / 'bin'
+    bin_dir.mkdir()
+    ip_log = tmppath / 'ip.log'
+    (bin_dir / 'sudo').write_text('#!/bin/sh\nexec "$@"\n')
+    (bin_dir / 'ip').write_text(
+        '#!/bin/sh\n'
+        f'echo "$@" >> {ip_log}\n'
+        f'[ "$2" != show ] || [ {int(device_exists)} = 1 ]\n')
+    for tool in bin_dir.iterdir():
+        tool.chmod(0o755)
+
+    computing.install_tap_scripts()
+    env = {**os.environ, 'PATH': f'{bin_dir}:{os.environ["PATH"]}'}
+    subprocess.run(
+        [computing.setup_script_path(), 'tap0', 'br0', 'user'],
+        env=env, check=True)
+    subprocess.run(
+        [computing.teardown_script_path(), 'tap0'], env=env, check=True)
+
+    deleted = 'link del tap0' in ip_log.read_text().splitlines()
+    assert deleted != device_exists
+
+
+def test_failed_image_creation_removes_vpn(
+        tmppath, config_dir, mock_service_manager: ServiceManager):
+    handler = computing.ComputingHandler(
+        radvd=FAKE_RADVD, service_manager=mock_service_manager,
+        base_image_folder=tmppath, user_image_folder=tmppath)
+    (tmppath / 'myimage.qcow2').touch()
+
+    vpn_established = threading.Event()
+
+    def establish_vpn(vpn_name, vm_id):
+        handler.established_vpns[vpn_name] = TincVirtualNetwork(
+            vpn_name, 50999, mock_service_manager)
+        vpn_established.set()
+        return f'vpn-{vm_id}', 'true', 'true'
 
-        # do not specify a base image
-        with pytest.raises(ValueError):
-            # make sure to exhaust the iterator
-            list(handler.create_vm({}))
+    def create_user_image(*args):
+        # fail only after the VPN setup has finished
+        vpn_established.wait(1)
+        raise QemuException('qemu-img failed')
+
+    with mock.patch.object(
+            handler, '_establish_vpn', side_effect=establish_vpn), \
+            mock.patch.object(handler, '_remove_vpn') as remove_vpn, \
+            mock.patch(
+                'aetherscale.computing.create_user_image',
+                side_effect=create_user_image):
+        with pytest.raises(QemuException):
+            list(handler.create_vm({'image': 'myimage', 'vpn': 'myvpn'}))
+
+    remove_vpn.assert_called_once()
+    assert remove_vpn.call_args[0][0].netname == 'myvpn'
+
+
+def test_failed_vpn_setup_removes_user_image(
+        tmppath, config_dir, mock_service_manager: ServiceManager):
+    handler = computing.ComputingHandler(
+        radvd=FAKE_RADVD, service_manager=mock_service_manager,
+        base_image_folder=tmppath, user_image_folder=tmppath)
+    (tmppath / 'myimage.qcow2').touch()
+
+    def create_user_image(vm_id, image_name, base_folder, user_folder):
+        user_image = computing.user_image_path(vm_id, user_folder)
+        user_image.touch()
+        return user_image
+
+    with mock.patch.object(
+            handler, '_establish_vpn',
+            side_effect=VpnException('tincd failed')), \
+            mock.patch(
+                'aetherscale.computing.create_user_image',
+                side_effect=create_user_image):
+        with pytest.raises(VpnException):
+            list(handler.create_vm({'image': 'myimage', 'vpn': 'myvpn'}))
+
+    assert list(tmppath.glob('*.qcow2')) == [tmppath / 'myimage.qcow2']
+
+
+def test_remove_vpn(config_dir, mock_service_manager: ServiceManager):
+    handler = computing.ComputingHandler(
+        radvd=None, service_manager=mock_service_manager)
+    vpn = TincVirtualNetwork('myvpn', 50998, mock_service_manager)
+    vpn.create_config('myhost')
+    handler.established_vpns['myvpn'] = vpn
+    handler.available_vpn_ports = set()
+
+    handler._remove_vpn(vpn)
+
+    assert not (config_dir / 'vpn/myvpn').exists()
+    assert 'myvpn' not in handler.established_vpns
+    assert handler.available_vpn_ports == {50998}
 
 
 def test_vm_id_systemd_unit():
     assert 'myvmid' == computing.vm_id_from_systemd_unit(
         computing.systemd_unit_name_for_vm('myvmid'))
+
+
+def test_vm_id_from_invalid_systemd_unit():
+    with pytest.raises(ValueError):
+        computing.vm_id_from_systemd_unit('aetherscale-radvd.service')
+
+    with pytest.raises(ValueError):
+        computing.vm_id_from_systemd_unit('aetherscale-vm-abc.service.bak')
+
+
+def test_load_existing_vpns(config_dir, mock_service_manager: ServiceManager):
+    tinc_dir = config_dir / 'vpn/myvpn/tinc'
+    tinc_dir.mkdir(parents=True)
+    (tinc_dir / 'tinc.conf').write_text(
+        'Name = myhost\nMode = switch\nPort = 50123\n')
+
+    handler = computing.ComputingHandler(
+        radvd=FAKE_RADVD, service_manager=mock_service_manager)
+
+    assert list(handler.established_vpns.keys()) == ['myvpn']
+    assert handler.established_vpns['myvpn'].port == 50123
+    # loading does not change any state, so nothing is written
+    assert not computing.vpn_snapshot_path().exists()
+    assert not (config_dir / 'networking').exists()
+
+
+def test_vpn_snapshot_is_refreshed(
+        config_dir, mock_service_manager: ServiceManager):
+    def create_vpn_config(netname: str, port: int):
+        tinc_dir = config_dir / f'vpn/{netname}/tinc'
+        tinc_dir.mkdir(parents=True)
+        (tinc_dir / 'tinc.conf').write_text(f'Port = {port}\n')
+
+    create_vpn_config('first', 50001)
+    handler = computing.ComputingHandler(
+        radvd=FAKE_RADVD, service_manager=mock_service_manager)
+    assert set(handler.established_vpns.keys()) == {'first'}
+    # written whenever a VPN is established
+    handler._save_vpn_snapshot()
+    assert computing.vpn_snapshot_path().is_file()
+
+    # a VPN folder created after the snapshot makes it outdated
+    os.utime(computing.vpn_snapshot_path(), (0, 0))
+    create_vpn_config('second', 50002)
+    handler = computing.ComputingHandler(
+        radvd=FAKE_RADVD, service_manager=mock_service_manager)
+    assert set(handler.established_vpns.keys()) == {'first', 'second'}
+    assert handler.established_vpns['second'].port == 50002
+
+
+@mock.patch.object(
+    TincVirtualNetwork, 'gen_keypair_async',
+    lambda self: contextlib.nullcontext())
+@mock.patch.object(TincVirtualNetwork, 'start_daemon')
+@mock.patch(
+    'aetherscale.networking.Iproute2Network.check_device_existence',
+    return_value=False)
+def test_two_handlers_establish_vpns(
+        check_device_existence, start_daemon, config_dir,
+        mock_service_manager: ServiceManager):
+    # e.g. the broker and a REST request, both started before any VPN
+    handlers = [
+        computing.ComputingHandler(
+            radvd=None, service_manager=mock_service_manager)
+        for _ in range(2)
+    ]
+    for handler in handlers:
+        # separate processes do not share the set of free ports
+        handler.available_vpn_ports = {50000, 50001}
+
+    handlers[0]._establish_vpn('first', 'vm1')
+    handlers[1]._establish_vpn('second', 'vm2')
+
+    ports = {
+        netname: vpn.port
+        for netname, vpn in computing.ComputingHandler(
+            radvd=None, service_manager=mock_service_manager
+        ).established_vpns.items()
+    }
+    assert set(ports.keys()) == {'first', 'second'}
+    assert ports['first'] != ports['second']
+
+
+def test_qemu_unit_file_install(
+        tmppath, config_dir, mock_service_manager: ServiceManager):
+    handler = computing.ComputingHandler(
+        radvd=None, service_manager=mock_service_manager)
+    qemu_config = computing.runtime.QemuStartupConfig(
+        vm_id='myvmid', hda_image=tmppath / 'myvmid.qcow2', interfaces=[])
+    unit_modes = []
+
+    def write_unit_file(unit_file, unit_name):
+        unit_modes.append(stat.S_IMODE(os.stat(unit_file).st_mode))
+        return True
+
+    with mock.patch.object(
+            mock_service_manager, 'write_unit_file',
+            side_effect=write_unit_file):
+        handler._create_qemu_systemd_unit(
+            'aetherscale-vm-myvmid.service', qemu_config, [], [])
+    assert unit_modes == [0o644]
+
+    with mock.patch.object(
+            mock_service_manager, 'write_unit_file', return_value=False):
+        with pytest.raises(RuntimeError):
+            handler._create_qemu_systemd_unit(
+                'aetherscale-vm-myvmid.service', qemu_config, [], [])
+
+
+@pytest.fixture
+def aio_detection():
+    computing.detect_qemu_aio_backend.cache_clear()
+    yield computing.detect_qemu_aio_backend
+    computing.detect_qemu_aio_backend.cache_clear()
+
+
+@mock.patch('aetherscale.config.QEMU_AIO', 'native')
+def test_qemu_aio_override(aio_detection):
+    assert aio_detection() == 'native'
+
+
+@pytest.mark.parametrize('version_output,backend', [
+    ('QEMU emulator version 8.2.2 (Debian 1:8.2.2+ds-0ubuntu1)', 'io_uring'),
+    ('QEMU emulator version 4.2.1', 'threads'),
+    ('', 'threads'),
+])
+@mock.patch('platform.release', return_value='6.1.0-generic')
+@mock.patch('subprocess.run')
+def test_qemu_aio_requires_recent_qemu(
+        subprocess_run, release, aio_detection, version_output, backend):
+    subprocess_run.return_value.stdout = version_output
+
+    with mock.patch('builtins.open', side_effect=OSError):
+        assert aio_detection() == backend
+
+
+@mock.patch('subprocess.run')
+def test_get_process_for_vm_uses_systemd_main_pid(subprocess_run):
+    subprocess_run.return_value.stdout = f'{os.getpid()}\n'
+
+    process = computing.get_process_for_vm('abcd1234')
+
+    assert process.pid == os.getpid()
+    assert 'MainPID' in subprocess_run.call_args[0][0]
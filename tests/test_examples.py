@@ -0,0 +1,39 @@
+import importlib.util
+from pathlib import Path
+import pytest
+
+
+EXAMPLES_DIR = Path(__file__).parent.parent / 'examples'
+
+
+@pytest.fixture(scope='module')
+def rabbitmq_example():
+    spec = importlib.util.spec_from_file_location(
+        'rabbitmq_vm_hosting', EXAMPLES_DIR / 'rabbitmq_vm_hosting.py')
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.mark.parametrize('ip,external', [
+    ('192.0.2.10', True),
+    ('2001:db8::10', True),
+    ('127.0.0.1', False),
+    ('::1', False),
+    ('fe80::1', False),
+    ('FEBF::1', False),
+    ('fe8::1', True),
+    ('fec0::1', True),
+    ('169.254.0.5', False),
+    ('not-an-ip', False),
+])
+def test_is_external_ip(rabbitmq_example, ip, external):
+    assert rabbitmq_example.is_external_ip(ip) == external
+
+
+def test_management_urls(rabbitmq_example):
+    assert rabbitmq_example.management_urls(
+        ['127.0.0.1', 'fe80::1', '192.0.2.10', '2001:db8::10']) == [
+        'http://192.0.2.10:15672/',
+        'http://[2001:db8::10]:15672/',
+    ]
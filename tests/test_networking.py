@@ -1,7 +1,7 @@
 from unittest import mock
 import pytest
 
-from aetherscale import networking
+from aetherscale import execution, networking
 
 
 def test_mac_address_is_random():
@@ -11,31 +11,52 @@ def test_mac_address_is_random():
     assert mac_a != mac_b
 
 
-def test_device_name_validation():
-    # must not raise exception
-    networking.Iproute2Network.validate_device_name('valid-dev')
-    networking.Iproute2Network.validate_device_name('qemu-tap-10')
-    networking.Iproute2Network.validate_device_name('fifteen-chars15')
-
-    with pytest.raises(networking.NetworkingException):
-        networking.Iproute2Network.validate_device_name('too-long-device-name')
-
-    with pytest.raises(networking.NetworkingException):
-        networking.Iproute2Network.validate_device_name('invalid space')
-
-    with pytest.raises(networking.NetworkingException):
-        networking.Iproute2Network.validate_device_name('non-ascii-日本')
-
-
-def test_ip_address_validation():
-    # must not raise exception
-    networking.Iproute2Network.validate_ip_address('10.0.0.1')
-    networking.Iproute2Network.validate_ip_address('2001:0db8::3b:0:1')
-    networking.Iproute2Network.validate_ip_address('10.0.0.1/32')
-    networking.Iproute2Network.validate_ip_address('2001:0db8::/64')
-
-    with pytest.raises(networking.NetworkingException):
-        networking.Iproute2Network.validate_ip_address('something-invalid')
+def test_mac_address_is_local_unicast():
+    for _ in range(100):
+        mac = networking.create_mac_address()
+        octets = mac.split(':')
+        assert len(octets) == 6
+        assert all(len(octet) == 2 for octet in octets)
+
+        first_octet = int(octets[0], 16)
+        assert first_octet & 0x02  # locally administered
+        assert not first_octet & 0x01  # unicast
+
+
+@pytest.mark.parametrize('name, valid', [
+    ('valid-dev', True),
+    ('qemu-tap-10', True),
+    ('fifteen-chars15', True),
+    ('too-long-device-name', False),
+    ('invalid space', False),
+    ('non-ascii-日本', False),
+])
+def test_device_name_validation(name, valid):
+    if valid:
+        # must not raise exception
+        networking.Iproute2Network.validate_device_name(name)
+    else:
+        with pytest.raises(networking.NetworkingException):
+            networking.Iproute2Network.validate_device_name(name)
+
+
+@pytest.mark.parametrize('ip_addr, valid', [
+    ('10.0.0.1', True),
+    ('2001:0db8::3b:0:1', True),
+    ('10.0.0.1/32', True),
+    ('2001:0db8::/64', True),
+    ('something-invalid', False),
+    ('10.0.0.1/33', False),
+    ('10.0.0.1/', False),
+    ('1.2.3', False),
+])
+def test_ip_address_validation(ip_addr, valid):
+    if valid:
+        # must not raise exception
+        networking.Iproute2Network.validate_ip_address(ip_addr)
+    else:
+        with pytest.raises(networking.NetworkingException):
+            networking.Iproute2Network.validate_ip_address(ip_addr)
 
 
 def test_iproute2_networking_scripts():
@@ -55,7 +76,7 @@ def test_iproute2_networking_scripts():
     assert 'addr add 10.0.0.2/24 dev eth0' in teardown_script
 
 
-@mock.patch('aetherscale.execution.run_command_chain')
+@mock.patch('aetherscale.execution.run_ip_batch')
 def test_iproute2_networking_direct_execution(command_chain):
     iproute = networking.Iproute2Network()
     iproute.bridged_network('unittestbr0', 'eth0')
@@ -64,3 +85,86 @@ def test_iproute2_networking_direct_execution(command_chain):
 
     bridge_command = ['sudo', 'ip', 'link', 'add', 'unittestbr0', 'type', 'bridge']
     assert bridge_command in command_chain.call_args[0][0]
+
+
+@mock.patch('subprocess.run')
+def test_ip_commands_are_batched(subprocess_run):
+    subprocess_run.return_value.returncode = 0
+
+    execution.run_ip_batch([
+        ['sudo', 'ip', 'link', 'add', 'unittestbr0', 'type', 'bridge'],
+        ['sudo', 'ip', 'link', 'set', 'unittestbr0', 'up'],
+        ['echo', 'no-ip-command'],
+        ['sudo', 'ip', 'link', 'set', 'eth0', 'master', 'unittestbr0'],
+    ])
+
+    calls = subprocess_run.call_args_list
+    assert len(calls) == 3
+    assert calls[0][0][0] == ['sudo', 'ip', '-batch', '-']
+    assert calls[0][1]['input'] == \
+        'link add unittestbr0 type bridge\nlink set unittestbr0 up\n'
+    assert calls[1][0][0] == ['echo', 'no-ip-command']
+    assert calls[2][1]['input'] == 'link set eth0 master unittestbr0\n'
+
+
+@mock.patch('subprocess.run')
+def test_ip_commands_with_unsafe_arguments_are_not_batched(subprocess_run):
+    subprocess_run.return_value.returncode = 0
+    command = ['sudo', 'ip', 'link', 'set', 'tap0\nnetns exec 1 sh', 'up']
+
+    execution.run_ip_batch([command])
+
+    calls = subprocess_run.call_args_list
+    assert len(calls) == 1
+    assert calls[0][0][0] == command
+    assert 'input' not in calls[0][1]
+
+
+@mock.patch('subprocess.run')
+def test_ip_batch_force_continues_after_failure(subprocess_run):
+    subprocess_run.return_value.returncode = 1
+
+    success = execution.run_ip_batch([
+        ['sudo', 'ip', 'link', 'del', 'unittesttap0'],
+        ['echo', 'no-ip-command'],
+    ], force=True)
+
+    assert not success
+    calls = subprocess_run.call_args_list
+    assert len(calls) == 2
+    assert calls[0][0][0] == ['sudo', 'ip', '-force', '-batch', '-']
+
+
+@mock.patch('subprocess.run')
+def test_device_existence_is_cached(subprocess_run):
+    subprocess_run.return_value.stdout = b'2: unittestbr1: <BROADCAST>'
+
+    assert networking.Iproute2Network.check_device_existence('unittestbr1')
+    assert networking.Iproute2Network.check_device_existence('unittestbr1')
+    assert subprocess_run.call_count == 1
+
+    # deleting the device must not leave a stale cache entry
+    iproute = networking.Iproute2Network()
+    iproute.deletion_commands.append(
+        ['sudo', 'ip', 'link', 'del', 'unittestbr1'])
+    iproute.teardown()
+
+    subprocess_run.return_value.stdout = b''
+    assert not networking.Iproute2Network.check_device_existence(
+        'unittestbr1')
+
+
+@mock.patch('subprocess.run')
+def test_tap_device_existence_is_not_cached(subprocess_run):
+    subprocess_run.return_value.stdout = b'5: unittesttap2: <BROADCAST>'
+
+    iproute = networking.Iproute2Network()
+    iproute.tap_device('unittesttap2', 'unittestuser')
+    assert iproute.creation_commands == []
+
+    # the device was removed outside of this process, e.g. by tincd
+    subprocess_run.return_value.stdout = b''
+    iproute = networking.Iproute2Network()
+    iproute.tap_device('unittesttap2', 'unittestuser')
+    assert len(iproute.creation_commands) > 0
+    assert subprocess_run.call_count == 2
@@ -0,0 +1,107 @@
+import pytest
+import socket
+import threading
+from unittest import mock
+
+from aetherscale import privhelper
+
+
+@pytest.fixture
+def privhelper_socket(tmppath):
+    socket_file = tmppath / 'priv.sock'
+
+    server = privhelper.create_server(socket_file)
+    t = threading.Thread(
+        target=server.serve_forever, kwargs={'poll_interval': 0.01})
+    t.daemon = True
+    t.start()
+
+    yield socket_file
+
+    server.shutdown()
+    server.server_close()
+
+
+@mock.patch('aetherscale.execution.run_ip_batch')
+def test_commands_are_run_by_helper(run_ip_batch, privhelper_socket):
+    run_ip_batch.return_value = True
+    client = privhelper.PrivClient(privhelper_socket)
+
+    assert client.run_chain([
+        ['sudo', 'ip', 'link', 'set', 'tap0', 'up'],
+        ['sudo', 'ip', 'link', 'del', 'tap1'],
+    ], force=True)
+    # second request re-uses the connection
+    assert client.run_chain([['sudo', 'ip', 'link', 'set', 'tap0', 'up']])
+
+    assert run_ip_batch.call_count == 2
+    assert run_ip_batch.call_args_list[0] == mock.call(
+        [['ip', 'link', 'set', 'tap0', 'up'], ['ip', 'link', 'del', 'tap1']],
+        force=True)
+    client.close()
+
+
+@mock.patch('aetherscale.execution.run_ip_batch')
+def test_helper_refuses_other_commands(run_ip_batch, privhelper_socket):
+    client = privhelper.PrivClient(privhelper_socket)
+
+    with pytest.raises(privhelper.PrivHelperException):
+        client.run_chain([['sudo', 'ip', 'netns', 'exec', 'x', 'sh']])
+    with pytest.raises(privhelper.PrivHelperException):
+        client.run_chain([['sudo', 'rm', '-rf', '/']])
+
+    run_ip_batch.assert_not_called()
+    client.close()
+
+
+@pytest.mark.parametrize('command', [
+    ['sudo', 'ip', 'link', 'set', 'tap0\nnetns exec 1 sh', 'up'],
+    ['sudo', 'ip', 'link', 'set', 'tap0 up', 'down'],
+    ['sudo', 'ip', 'link', 'set', '', 'up'],
+    ['sudo', 'ip', 'link', 'set', 'tap0\x00', 'up'],
+    ['sudo', 'ip', 'link', 'set', 'tap0', 'alias', 'x#'],
+    ['sudo', 'ip', 'link', 'set', 'tap0', 'alias', 'x\\'],
+    ['sudo', 'ip', 'link', 'set', 'tap0', 'alias', '"x'],
+    ['sudo', 'ip', 'link', 'set', 'tap0', 'alias', "'x"],
+])
+@mock.patch('aetherscale.execution.run_ip_batch')
+def test_helper_refuses_injected_arguments(
+        run_ip_batch, privhelper_socket, command):
+    client = privhelper.PrivClient(privhelper_socket)
+
+    with pytest.raises(privhelper.PrivHelperException):
+        client.run_chain([command])
+
+    run_ip_batch.assert_not_called()
+    client.close()
+
+
+def test_request_is_not_repeated_after_lost_reply(tmppath):
+    socket_file = tmppath / 'priv.sock'
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(str(socket_file))
+    server.listen(2)
+    requests = []
+
+    def serve():
+        # answer the first request, run the second one but lose the reply
+        conn, _ = server.accept()
+        requests.append(privhelper.recv_message(conn))
+        privhelper.send_message(conn, {'success': True})
+        requests.append(privhelper.recv_message(conn))
+        conn.close()
+
+    t = threading.Thread(target=serve)
+    t.start()
+
+    client = privhelper.PrivClient(socket_file)
+    try:
+        assert client.run_chain([['sudo', 'ip', 'tuntap', 'add', 'tap0']])
+        with pytest.raises(privhelper.PrivHelperException):
+            client.run_chain([['sudo', 'ip', 'tuntap', 'add', 'tap1']])
+    finally:
+        t.join()
+        client.close()
+        server.close()
+
+    assert len(requests) == 2
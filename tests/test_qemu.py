@@ -1,95 +1,357 @@
+import asyncio
 import contextlib
+import itertools
 import json
+import os
 from pathlib import Path
 import pytest
+import queue
+import selectors
 import socket
 import tempfile
 import threading
-import uuid
+from typing import Callable, Iterator, Optional, Set
 
+from aetherscale.qemu import runtime
+from aetherscale.qemu.exceptions import QemuException
 from aetherscale.qemu.runtime import QemuMonitor, QemuProtocol
 
 
-class MockQemuServer:
-    qmp_init_msg = {"QMP": {"version": {"qemu": {
-        "micro": 0, "minor": 6, "major": 1
-    }, "package": ""}, "capabilities": []}}
-    mock_ok_response = {'return': {}}
+_socket_counter = itertools.count()
 
-    def __init__(self, socket_file: str, protocol: QemuProtocol):
-        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+def new_socket_file() -> Path:
+    """Unique socket path for this test process"""
+    return Path(tempfile.gettempdir()) / \
+        f'aetherscale-test-{os.getpid()}-{next(_socket_counter)}'
+
+
+def encode_message(message) -> bytes:
+    return json.dumps(message).encode('ascii') + b'\r\n'
+
+
+QMP_INIT_BYTES = encode_message({"QMP": {"version": {"qemu": {
+    "micro": 0, "minor": 6, "major": 1
+}, "package": ""}, "capabilities": []}})
+OK_BYTES = encode_message({'return': {}})
+
+
+def build_mock_response(protocol: QemuProtocol, message) -> bytes:
+    if protocol == QemuProtocol.QGA:
+        if message['execute'] == 'guest-sync':
+            return encode_message({'return': message['arguments']['id']})
+
+    # for now always return with OK status
+    return OK_BYTES
+
+
+class MockServerLoop:
+    """Selector loop in a single thread that serves the connections of all
+    mock servers registered with it"""
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self._calls = queue.SimpleQueue()
+        # written to whenever a call is queued
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self.selector.register(self._wakeup_recv, selectors.EVENT_READ)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.call(None)
+        self._thread.join()
+
+    def call(self, func: Optional[Callable[[], None]]):
+        """Run func in the loop thread and wait for it, the selector must
+        not be modified from other threads. None stops the loop."""
+        done = threading.Event()
+        self._calls.put((func, done))
+        self._wakeup_send.send(b'\0')
+        done.wait()
+
+    def _run(self):
+        while True:
+            woken_up = False
+
+            for key, _ in self.selector.select():
+                if key.fileobj is self._wakeup_recv:
+                    woken_up = True
+                else:
+                    # data is the callback of the registered socket
+                    key.data(key.fileobj)
+
+            # calls might close sockets, so run them after all callbacks of
+            # this round
+            if woken_up and not self._run_calls():
+                self._close()
+                return
+
+    def _run_calls(self) -> bool:
+        self._wakeup_recv.recv(4096)
+
+        while not self._calls.empty():
+            func, done = self._calls.get()
+            if func is None:
+                done.set()
+                return False
+
+            func()
+            done.set()
+
+        return True
+
+    def _close(self):
+        self.selector.close()
+        self._wakeup_recv.close()
+        self._wakeup_send.close()
+
+
+class MockQemuServer:
+    def __init__(
+            self, socket_file: str, protocol: QemuProtocol,
+            loop: MockServerLoop):
+        self._sock = socket.socket(
+            socket.AF_UNIX, socket.SOCK_STREAM | socket.SOCK_NONBLOCK)
         self._socket_file = socket_file
         self.received_executes = []
         self.protocol = protocol
+        self._loop = loop
+        self._connections: Set[socket.socket] = set()
+        self._decoder = json.JSONDecoder()
 
     def __enter__(self):
         self._sock.bind(self._socket_file)
+        # listen before any client can try to connect
+        self._sock.listen()
+        self._loop.call(lambda: self._loop.selector.register(
+            self._sock, selectors.EVENT_READ, self._on_connect))
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self._sock.close()
+        self._loop.call(self._close)
 
-    def listen(self):
-        self._sock.listen()
+    @property
+    def socket_file(self) -> Path:
+        return Path(self._socket_file)
+
+    def reset(self):
+        self.received_executes = []
+
+    def _close(self):
+        for conn in [self._sock, *self._connections]:
+            self._loop.selector.unregister(conn)
+            conn.close()
 
-        conn, addr = self._sock.accept()
-        filelike = conn.makefile('rb')
+        self._connections.clear()
+
+    def _on_connect(self, sock: socket.socket):
+        conn, addr = sock.accept()
+        self._connections.add(conn)
 
         if self.protocol == QemuProtocol.QMP:
-            self._send_message(self.qmp_init_msg, conn)
+            conn.sendall(QMP_INIT_BYTES)
+
+        # received bytes that were not decoded yet, one buffer per client
+        buffer = bytearray()
+        self._loop.selector.register(
+            conn, selectors.EVENT_READ,
+            lambda conn: self._on_readable(conn, buffer))
 
+    def _on_readable(self, conn: socket.socket, buffer: bytearray):
         try:
-            while True:
-                msg = self._recv_message(filelike)
-                self.received_executes.append(msg['execute'])
-
-                # for now always return with OK status
-                response = self._build_response(msg)
-                self._send_message(response, conn)
-        except json.JSONDecodeError:
+            chunk = conn.recv(4096)
+        except OSError:
+            chunk = b''
+
+        if not chunk:
+            # client disconnected
+            self._loop.selector.unregister(conn)
+            self._connections.discard(conn)
             conn.close()
+            return
+
+        buffer += chunk
+        self._on_data(conn, buffer)
+
+    def _on_data(self, conn: socket.socket, buffer: bytearray):
+        for msg in self._pop_messages(buffer):
+            self.received_executes.append(msg['execute'])
 
-    def _build_response(self, message):
-        if self.protocol == QemuProtocol.QGA:
-            if message['execute'] == 'guest-sync':
-                return {'return': message['arguments']['id']}
+            conn.sendall(build_mock_response(self.protocol, msg))
 
-        return self.mock_ok_response
+    def _pop_messages(self, buffer: bytearray) -> Iterator:
+        while True:
+            # QGA clients send a 0xff byte to flush the agent's parser, it is
+            # not part of any message
+            unparsed = buffer.lstrip(b'\xff \t\r\n')
+            del buffer[:len(buffer) - len(unparsed)]
 
-    def _send_message(self, message, conn):
-        msg_with_newline = json.dumps(message) + '\r\n'
-        conn.send(msg_with_newline.encode('ascii'))
+            if not buffer:
+                return
 
-    def _recv_message(self, filelike):
-        line = filelike.readline()
-        return json.loads(line.decode('utf-8'))
+            text = buffer.decode('utf-8')
+            try:
+                msg, end = self._decoder.raw_decode(text)
+            except json.JSONDecodeError:
+                # message is incomplete, wait for more data
+                return
+
+            del buffer[:len(text[:end].encode('utf-8'))]
+            yield msg
 
 
 @contextlib.contextmanager
 def run_mock_qemu_server(
-        socket_file: str, protocol: QemuProtocol) -> MockQemuServer:
-    with MockQemuServer(socket_file, protocol) as mock_server:
-        t = threading.Thread(target=mock_server.listen)
-        t.daemon = True
-        t.start()
+        socket_file: str, protocol: QemuProtocol,
+        loop: MockServerLoop) -> Iterator[MockQemuServer]:
+    with MockQemuServer(socket_file, protocol, loop) as mock_server:
         yield mock_server
 
+    os.unlink(socket_file)
+
+
+class AsyncMockQemuServer:
+    """Mock server for the asyncio clients, runs in the test's event loop
+    instead of a thread"""
+
+    def __init__(self, socket_file: str, protocol: QemuProtocol):
+        self._socket_file = socket_file
+        self.received_executes = []
+        self.protocol = protocol
+
+    @property
+    def socket_file(self) -> Path:
+        return Path(self._socket_file)
+
+    async def __aenter__(self):
+        self._server = await asyncio.start_unix_server(
+            self._handle, path=self._socket_file)
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self._server.close()
+        await self._server.wait_closed()
+        os.unlink(self._socket_file)
+
+    async def _handle(
+            self, reader: asyncio.StreamReader,
+            writer: asyncio.StreamWriter):
+        if self.protocol == QemuProtocol.QMP:
+            writer.write(QMP_INIT_BYTES)
+
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+
+            # skip the flush byte of QGA clients
+            msg = json.loads(line.lstrip(b'\xff'))
+            self.received_executes.append(msg['execute'])
+
+            writer.write(build_mock_response(self.protocol, msg))
+            await writer.drain()
+
+        writer.close()
+
+
+@pytest.fixture(scope='module')
+def mock_server_loop() -> Iterator[MockServerLoop]:
+    with MockServerLoop() as loop:
+        yield loop
+
 
-def test_initializes_with_capabilities_acceptance():
-    sock_file = Path(tempfile.gettempdir()) / str(uuid.uuid4())
+@pytest.fixture(scope='module')
+def qmp_server(mock_server_loop) -> Iterator[MockQemuServer]:
+    sock_file = new_socket_file()
+    with run_mock_qemu_server(
+            str(sock_file), QemuProtocol.QMP, mock_server_loop) as server:
+        yield server
 
-    with run_mock_qemu_server(str(sock_file), QemuProtocol.QMP) as mock_server:
-        QemuMonitor(sock_file, QemuProtocol.QMP)
-        assert 'qmp_capabilities' in mock_server.received_executes
 
+@pytest.fixture(scope='module')
+def qga_server(mock_server_loop) -> Iterator[MockQemuServer]:
+    sock_file = new_socket_file()
+    with run_mock_qemu_server(
+            str(sock_file), QemuProtocol.QGA, mock_server_loop) as server:
+        yield server
 
-def test_timeout(timeout):
-    sock_file = Path(tempfile.gettempdir()) / str(uuid.uuid4())
+
+def test_initializes_with_capabilities_acceptance(qmp_server):
+    qmp_server.reset()
+
+    QemuMonitor(qmp_server.socket_file, QemuProtocol.QMP)
+    assert 'qmp_capabilities' in qmp_server.received_executes
+
+
+def test_guest_agent_handshake(qga_server):
+    qga_server.reset()
+
+    # the handshake starts with a 0xff byte that the server has to skip
+    QemuMonitor(qga_server.socket_file, QemuProtocol.QGA)
+    assert qga_server.received_executes == ['guest-sync']
+
+
+def test_timeout(timeout, qga_server):
     # A QMP protocol client on a Guest Agent server will have to timeout,
     # because it expects to receive a welcome capabilities message from the
     # server
+    with timeout(1):  # if function does not finish after 1s, error-out
+        with pytest.raises(socket.timeout):
+            QemuMonitor(qga_server.socket_file, QemuProtocol.QMP, timeout=0.1)
+
+
+def test_connection_closed_mid_message(timeout):
+    sock_file = new_socket_file()
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(str(sock_file))
+    server.listen(1)
+
+    def send_partial_greeting():
+        conn, _ = server.accept()
+        conn.sendall(b'{"QMP": {')
+        conn.close()
+
+    t = threading.Thread(target=send_partial_greeting)
+    t.start()
+
+    try:
+        with timeout(1):
+            with pytest.raises(QemuException, match='connection closed'):
+                QemuMonitor(sock_file, QemuProtocol.QMP)
+    finally:
+        t.join()
+        server.close()
+        sock_file.unlink()
+
+
+def test_guest_agent_ip_addresses_are_cached():
+    sock_file = new_socket_file()
+    runtime._cache_ip_addresses(sock_file, ['10.0.0.5'])
+
+    # the socket does not exist, so the addresses must come from the cache
+    fetcher = runtime.GuestAgentIpAddress(sock_file)
+    assert fetcher.fetch_ip_addresses() == ['10.0.0.5']
+
+    runtime.invalidate_ip_address_cache(sock_file)
+    with pytest.raises(OSError):
+        runtime.GuestAgentIpAddress(sock_file).fetch_ip_addresses()
+
+
+def test_async_monitor_guest_agent():
+    sock_file = new_socket_file()
+
+    async def communicate():
+        async with AsyncMockQemuServer(str(sock_file), QemuProtocol.QGA) \
+                as server:
+            monitor = await runtime.AsyncQemuMonitor.connect(
+                server.socket_file, QemuProtocol.QGA)
+            await monitor.execute('guest-info')
+            await monitor.close()
+
+        return server.received_executes
 
-    with run_mock_qemu_server(str(sock_file), QemuProtocol.QGA) as mock_server:
-        with timeout(1):  # if function does not finish after 1s, error-out
-            with pytest.raises(socket.timeout):
-                QemuMonitor(sock_file, QemuProtocol.QMP, timeout=0.1)
+    assert asyncio.run(communicate()) == ['guest-sync', 'guest-info']
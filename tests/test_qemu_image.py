@@ -1,10 +1,17 @@
 import os
+from pathlib import Path
 import pytest
+from typing import Dict
 
 from aetherscale.qemu import image
 from aetherscale.qemu.exceptions import QemuException
 
 
+def dir_entries(directory: Path) -> Dict[str, os.DirEntry]:
+    with os.scandir(directory) as it:
+        return {entry.name: entry for entry in it}
+
+
 def test_copies_startup_script_to_vm_dir(tmppath):
     # Create directories that normally exist in mounted OS
     (tmppath / 'etc/systemd/system').mkdir(parents=True, exist_ok=True)
@@ -12,9 +19,11 @@ def test_copies_startup_script_to_vm_dir(tmppath):
 
     image.install_startup_script('echo something', tmppath)
 
-    assert os.path.isfile(tmppath / f'root/{image.STARTUP_FILENAME}.sh')
-    assert os.path.isfile(
-        tmppath / f'etc/systemd/system/{image.STARTUP_FILENAME}.service')
+    root_entries = dir_entries(tmppath / 'root')
+    assert root_entries[f'{image.STARTUP_FILENAME}.sh'].is_file()
+
+    unit_entries = dir_entries(tmppath / 'etc/systemd/system')
+    assert unit_entries[f'{image.STARTUP_FILENAME}.service'].is_file()
 
 
 def test_mount_invalid_image(tmppath):
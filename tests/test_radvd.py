@@ -1,3 +1,4 @@
+import io
 import os
 import pytest
 import stat
@@ -6,12 +7,12 @@ from aetherscale.vpn import radvd
 
 
 def test_add_interface_config(tmppath):
-    r = radvd.Radvd(tmppath / 'radvd.conf', '2001:0db8:0')
+    stream = io.StringIO()
+    r = radvd.Radvd(tmppath / 'radvd.conf', '2001:0db8:0', stream)
     r.add_interface('my-interface', '2001:0db8:0::/64')
     r.add_interface('my-second-interface', '2001:0db8:1::/64')
 
-    with open(r.config_file) as f:
-        content = f.read()
+    content = stream.getvalue()
 
     assert 'my-interface' in content
     assert '001:0db8::/64'
@@ -19,7 +20,7 @@ def test_add_interface_config(tmppath):
 
 
 def test_cannot_assign_same_prefix_twice(tmppath):
-    r = radvd.Radvd(tmppath / 'radvd.conf', '2001:0db8:0')
+    r = radvd.Radvd(tmppath / 'radvd.conf', '2001:0db8:0', io.StringIO())
     r.add_interface('first', '2001:0db8::/64')
 
     with pytest.raises(radvd.RadvdException):
@@ -27,7 +28,9 @@ def test_cannot_assign_same_prefix_twice(tmppath):
 
 
 def test_generate_next_prefix(tmppath):
-    r = radvd.Radvd(tmppath / 'radvd.conf', prefix='2001:0db8:0')
+    r = radvd.Radvd(
+        tmppath / 'radvd.conf', prefix='2001:0db8:0',
+        config_stream=io.StringIO())
     prefix = r.generate_prefix()
     r.add_interface('interface', prefix)
     prefix2 = r.generate_prefix()
@@ -43,5 +46,34 @@ def test_config_is_readonly(tmppath):
 
 
 def test_drops_privileges(tmppath):
-    r = radvd.Radvd(tmppath / 'radvd.conf', '2001:0db8:0')
+    r = radvd.Radvd(tmppath / 'radvd.conf', '2001:0db8:0', io.StringIO())
     assert '-u' in r.get_start_command()
+
+
+def test_bulk_edit(tmppath):
+    r = radvd.Radvd(tmppath / 'radvd.conf', '2001:0db8:0')
+
+    with r.bulk_edit():
+        r.add_interface('first', r.generate_prefix())
+        r.add_interface('second', r.generate_prefix())
+
+    content = r.config_file.read_text()
+    assert 'first' in content
+    assert 'second' in content
+    assert stat.S_IMODE(os.stat(r.config_file).st_mode) == 0o400
+
+
+def test_remove_interface(tmppath):
+    r = radvd.Radvd(tmppath / 'radvd.conf', '2001:0db8:0')
+    first_prefix = r.generate_prefix()
+    r.add_interface('first', first_prefix)
+    r.add_interface('second', r.generate_prefix())
+
+    r.remove_interface('first')
+
+    content = r.config_file.read_text()
+    assert 'first' not in content
+    assert 'second' in content
+    assert stat.S_IMODE(os.stat(r.config_file).st_mode) == 0o400
+    # the prefix of the removed interface is free again
+    assert r.generate_prefix() == first_prefix
@@ -1,7 +1,9 @@
 from pathlib import Path
+import pytest
 import tempfile
 from unittest import mock
 
+from aetherscale import services
 from aetherscale.services import SystemdServiceManager
 
 
@@ -40,3 +42,158 @@ def test_systemd_calls_system_binary(subprocess_run, tmppath):
         function('test.service')
         assert 'systemctl' in subprocess_run.call_args[0][0]
         assert keyword in subprocess_run.call_args[0][0]
+
+
+@mock.patch('subprocess.run')
+def test_systemd_bulk_status(subprocess_run, tmppath):
+    systemd = SystemdServiceManager(tmppath)
+    subprocess_run.return_value.stdout = 'active\ninactive\nfailed\n'
+
+    status = systemd.bulk_status(['a.service', 'b.service', 'c.service'])
+
+    assert status == {
+        'a.service': True,
+        'b.service': False,
+        'c.service': False,
+    }
+    assert subprocess_run.call_count == 1
+    assert 'is-active' in subprocess_run.call_args[0][0]
+
+
+@mock.patch('subprocess.run')
+def test_systemd_reload_and_activate(subprocess_run, tmppath):
+    systemd = SystemdServiceManager(tmppath)
+    subprocess_run.return_value.returncode = 0
+
+    assert systemd.reload_and_activate('test.service')
+
+    commands = [call[0][0] for call in subprocess_run.call_args_list]
+    assert commands == [
+        ['systemctl', '--user', 'daemon-reload'],
+        ['systemctl', '--user', 'enable', 'test.service', '--now'],
+    ]
+
+
+@mock.patch('subprocess.run')
+def test_systemd_install_simple_services(subprocess_run, tmppath):
+    systemd = SystemdServiceManager(tmppath)
+    subprocess_run.return_value.returncode = 0
+
+    systemd.install_simple_services([
+        ('/usr/bin/true', 'first.service', None),
+        ('/usr/bin/false', 'second.service', 'Second service'),
+    ])
+
+    assert 'ExecStart=/usr/bin/true\n' in \
+        (tmppath / 'first.service').read_text()
+    assert 'Description=Second service\n' in \
+        (tmppath / 'second.service').read_text()
+    # systemd only has to reload once for all services
+    assert subprocess_run.call_count == 1
+
+
+@mock.patch('subprocess.run')
+def test_systemd_batch_reloads_once(subprocess_run, tmppath):
+    systemd = SystemdServiceManager(tmppath)
+    subprocess_run.return_value.returncode = 0
+
+    with systemd.batch():
+        systemd.install_simple_service('/usr/bin/true', 'first.service')
+        systemd.install_simple_service('/usr/bin/true', 'second.service')
+        assert subprocess_run.call_count == 0
+
+    assert subprocess_run.call_count == 1
+    assert 'daemon-reload' in subprocess_run.call_args[0][0]
+
+
+@mock.patch('subprocess.run')
+def test_systemd_install_service_contents(subprocess_run, tmppath):
+    systemd = SystemdServiceManager(tmppath)
+    subprocess_run.return_value.returncode = 0
+
+    assert systemd.install_service_contents('[Unit]\n', 'test.service')
+
+    assert (tmppath / 'test.service').read_text() == '[Unit]\n'
+    assert 'daemon-reload' in subprocess_run.call_args[0][0]
+
+
+class FakeDBusError(Exception):
+    pass
+
+
+@pytest.fixture
+def dbus_manager(tmppath):
+    """DbusSystemdServiceManager with a mocked pystemd. Units end up in the
+    states given in unit_states, jobs are queued for job_polls polls."""
+    unit_states = {}
+    job_polls = {'remaining': 0}
+
+    def list_jobs():
+        if job_polls['remaining'] > 0:
+            job_polls['remaining'] -= 1
+            return [(1, b'x.service', b'start', b'running', b'/job/1', b'')]
+        return []
+
+    def unit(name, bus, _autoload):
+        if name not in unit_states:
+            raise FakeDBusError(name)
+        return mock.Mock(Unit=mock.Mock(ActiveState=unit_states[name]))
+
+    with mock.patch('aetherscale.services.DBus', create=True), \
+            mock.patch('aetherscale.services.Manager', create=True) as mgr, \
+            mock.patch('aetherscale.services.Unit', unit, create=True), \
+            mock.patch(
+                'aetherscale.services.DBusBaseError', FakeDBusError,
+                create=True), \
+            mock.patch('aetherscale.services.DBUS_JOB_TIMEOUT', 0.2):
+        manager = mgr.return_value.Manager
+        for method in ('StartUnit', 'StopUnit', 'RestartUnit'):
+            getattr(manager, method).return_value = b'/job/1'
+        manager.ListJobs.side_effect = list_jobs
+
+        service_manager = services.DbusSystemdServiceManager(tmppath)
+        yield service_manager, manager, unit_states, job_polls
+
+
+def test_dbus_start_waits_for_job(dbus_manager):
+    service_manager, manager, unit_states, job_polls = dbus_manager
+    unit_states[b'x.service'] = b'active'
+    job_polls['remaining'] = 3
+
+    assert service_manager.start_service('x.service')
+    manager.StartUnit.assert_called_once_with(b'x.service', b'replace')
+    assert manager.ListJobs.call_count == 4
+
+
+def test_dbus_failed_start_is_reported(dbus_manager):
+    # e.g. ExecStartPre failed, the job is done but the unit is not running
+    service_manager, manager, unit_states, _ = dbus_manager
+    unit_states[b'x.service'] = b'failed'
+
+    assert not service_manager.start_service('x.service')
+    assert service_manager.stop_service('x.service')
+
+
+def test_dbus_job_timeout(dbus_manager):
+    service_manager, manager, unit_states, job_polls = dbus_manager
+    unit_states[b'x.service'] = b'active'
+    job_polls['remaining'] = 10 ** 6
+
+    assert not service_manager.stop_service('x.service')
+
+
+def test_dbus_manager_errors(dbus_manager):
+    service_manager, manager, _, _ = dbus_manager
+    manager.RestartUnit.side_effect = FakeDBusError('no such unit')
+
+    assert not service_manager.restart_service('x.service')
+    assert not service_manager.service_is_running('missing.service')
+    assert service_manager.enable_service('x.service')
+    manager.EnableUnitFiles.assert_called_once_with(
+        [b'x.service'], False, True)
+
+
+def test_dbus_close(dbus_manager):
+    service_manager, _, _, _ = dbus_manager
+    service_manager.close()
+    service_manager._bus.close.assert_called_once()
@@ -0,0 +1,27 @@
+import pytest
+import time
+
+from aetherscale import timing
+
+
+def test_check_deadline():
+    # outside of a timeout block there is no deadline
+    timing.check_deadline()
+
+    with timing.timeout(10):
+        timing.check_deadline()
+
+    with pytest.raises(TimeoutError):
+        with timing.timeout(0.01):
+            time.sleep(0.02)
+            timing.check_deadline()
+
+
+def test_nested_timeout_keeps_outer_deadline():
+    with timing.timeout(1):
+        with timing.timeout(60):
+            assert timing.remaining_time() <= 1
+
+        assert timing.remaining_time() <= 1
+
+    assert timing.remaining_time() is None
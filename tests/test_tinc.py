@@ -0,0 +1,86 @@
+import pytest
+from unittest import mock
+
+from aetherscale.vpn import tinc
+from aetherscale.vpn.tinc import TincVirtualNetwork
+
+
+def test_create_config_with_peers(config_dir, mock_service_manager):
+    vpn = TincVirtualNetwork('testnet', 50001, mock_service_manager)
+    vpn.create_config('myhost')
+    vpn.add_peers([
+        ('peerone', '192.0.2.1', 'pubkey-one'),
+        ('peertwo', '192.0.2.2', 'pubkey-two'),
+    ])
+
+    tinc_dir = config_dir / 'vpn/testnet/tinc'
+    tinc_conf = (tinc_dir / 'tinc.conf').read_text().splitlines()
+    assert 'Port = 50001' in tinc_conf
+    assert 'ConnectTo = peerone' in tinc_conf
+    assert 'ConnectTo = peertwo' in tinc_conf
+
+    peer_host = (tinc_dir / 'hosts/peertwo').read_text()
+    assert 'Address = 192.0.2.2' in peer_host
+    assert 'pubkey-two' in peer_host
+
+
+def test_teardown_removes_config(config_dir, mock_service_manager):
+    vpn = TincVirtualNetwork('testnet', 50001, mock_service_manager)
+    vpn.create_config('myhost')
+    vpn.add_peer('peerone', '192.0.2.1', 'pubkey-one')
+    assert vpn.network_exists()
+
+    vpn.teardown_tinc_config()
+    assert not vpn.network_exists()
+    assert (config_dir / 'vpn/testnet').is_dir()
+
+    # a torn down network can be configured again
+    vpn.create_config('myhost')
+    vpn.add_peer('peerone', '192.0.2.1', 'pubkey-one')
+    assert (config_dir / 'vpn/testnet/tinc/hosts/peerone').is_file()
+
+
+def test_bulk_start(config_dir, mock_service_manager):
+    vpns = [
+        TincVirtualNetwork(f'net{i}', 50000 + i, mock_service_manager)
+        for i in range(3)
+    ]
+    tinc.bulk_start([(vpn, 'true', 'true') for vpn in vpns])
+
+    for vpn in vpns:
+        assert mock_service_manager.service_is_running(vpn.service_name)
+
+
+@mock.patch('subprocess.Popen')
+def test_failed_keygen_raises(popen, config_dir, mock_service_manager):
+    popen.return_value.wait.return_value = 1
+    vpn = TincVirtualNetwork('testnet', 50001, mock_service_manager)
+
+    with pytest.raises(tinc.VpnException):
+        with vpn.gen_keypair_async():
+            pass
+
+
+@mock.patch('subprocess.Popen')
+def test_keygen_is_waited_for_on_error(
+        popen, config_dir, mock_service_manager):
+    popen.return_value.wait.return_value = 0
+    vpn = TincVirtualNetwork('testnet', 50001, mock_service_manager)
+
+    with pytest.raises(RuntimeError):
+        with vpn.gen_keypair_async():
+            raise RuntimeError('device setup failed')
+
+    popen.return_value.wait.assert_called_once()
+
+
+def test_config_dir_removed_by_other_process(config_dir, mock_service_manager):
+    vpn = TincVirtualNetwork('testnet', 50001, mock_service_manager)
+    vpn.create_config('myhost')
+
+    # another process tears down the network without updating our cache
+    tinc._fast_rmtree(str(config_dir / 'vpn/testnet'))
+
+    vpn = TincVirtualNetwork('testnet', 50001, mock_service_manager)
+    vpn.create_config('myhost')
+    assert (config_dir / 'vpn/testnet/tinc/hosts/myhost').is_file()